@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+from flask import g, request, make_response
+
+# Request threads per worker (gunicorn.conf.py). Every admitted or queued request holds one,
+# so the class limits below are fractions of it, leaving a quarter for unclassified pages.
+WORKER_THREADS = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+class ConcurrencyLimiter:
+    """Bounded concurrency with a bounded, time-limited wait queue"""
+
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.peak_waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting up to queue_timeout; False means shed the request"""
+        with self._condition:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                self.admitted += 1
+                return True
+
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'active': self.active,
+                'queue_depth': self.waiting,
+                'peak_queue_depth': self.peak_waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+
+def _limiter_from_env(name, max_concurrent, max_queue, queue_timeout):
+    prefix = f"ADMISSION_{name.upper()}"
+    return ConcurrencyLimiter(
+        name,
+        max_concurrent=int(os.environ.get(f"{prefix}_LIMIT", max_concurrent)),
+        max_queue=int(os.environ.get(f"{prefix}_QUEUE", max_queue)),
+        queue_timeout=float(os.environ.get(f"{prefix}_TIMEOUT", queue_timeout)),
+    )
+
+
+# Route classes: bcrypt-bound form posts, and pages that fan out into Firestore reads.
+# Endpoints not listed here (public pages, static files) are never queued.
+ROUTE_CLASSES = {
+    ('register', 'POST'): 'cpu',
+    ('login', 'POST'): 'cpu',
+    ('dashboard', 'GET'): 'firestore',
+    ('book_appointment', 'POST'): 'firestore',
+    ('admin_dashboard', 'GET'): 'firestore',
+    ('admin_users', 'GET'): 'firestore',
+    ('admin_search_users', 'GET'): 'firestore',
+    ('admin_appointments', 'GET'): 'firestore',
+    ('admin_view_user', 'GET'): 'firestore',
+    ('export_appointments', 'GET'): 'firestore',
+    ('export_patient_histories', 'GET'): 'firestore',
+}
+
+
+class AdmissionControl:
+    """Per-route-class load shedding: fast 503 + Retry-After instead of piling up workers"""
+
+    def __init__(self, app=None, route_classes=None):
+        self.route_classes = route_classes or ROUTE_CLASSES
+        # Short waits: a request parked on a thread for long is the pile-up this is meant to prevent
+        eighth = max(1, WORKER_THREADS // 8)
+        self.limiters = {
+            'cpu': _limiter_from_env('cpu', max_concurrent=eighth, max_queue=eighth, queue_timeout=0.5),
+            'firestore': _limiter_from_env('firestore', max_concurrent=max(1, WORKER_THREADS // 4),
+                                           max_queue=eighth, queue_timeout=1.0),
+        }
+        self.retry_after = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))
+        reserved = sum(limiter.max_concurrent + limiter.max_queue for limiter in self.limiters.values())
+        if reserved >= WORKER_THREADS:
+            print(f"Warning: admission classes can hold {reserved} of {WORKER_THREADS} threads; "
+                  f"unclassified pages will queue behind them")
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def route_class(self, endpoint, method):
+        if method == 'HEAD':
+            method = 'GET'
+        return self.route_classes.get((endpoint, method))
+
+    def stats(self):
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+    def _before_request(self):
+        limiter = self.limiters.get(self.route_class(request.endpoint, request.method))
+        if limiter is None:
+            return None
+
+        if not limiter.acquire():
+            print(f"Admission: shedding {request.method} {request.path} ({limiter.name} saturated)")
+            response = make_response('Service is busy, please retry shortly.', 503)
+            response.headers['Retry-After'] = str(self.retry_after)
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+
+        g.admission_limiter = limiter
+        return None
+
+    def _teardown_request(self, exc=None):
+        limiter = g.pop('admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
+
+# Global instance
+admission_control = AdmissionControl()
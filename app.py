@@ -1,7 +1,14 @@
 import os
+import json
+import asyncio
+import queue
 import uuid
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+import hmac
+import click
+import itertools
+import time
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, get_flashed_messages, session, Response, stream_with_context, jsonify, get_template_attribute
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from flask_mail import Mail, Message
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
@@ -9,68 +16,91 @@ from datetime import datetime
 from functools import wraps
 from aws_storage import cloudinary_storage
 from firebase_db import firebase_db
+from async_firebase_db import async_firebase_db
+from appointment_feed import appointment_feed, APPOINTMENT_FEED_STREAM_SECONDS
+from patient_search import patient_search
+from slots import SlotUnavailableError, InvalidStatusTransitionError, describe_slots, SLOT_MINUTES
+from admission import admission_control
+from exports import EXPORT_FORMATS, APPOINTMENT_EXPORT_FIELDS, DIAGNOSIS_EXPORT_FIELDS, PatientLookup, join_patients
+from compression import CompressionMiddleware
+from reminders import ReminderSender
+from attachment_gc import collect_orphaned_attachments
+from booking_queue import booking_queue
+from template_cache import TEMPLATE_WARMUP, configure_template_cache, warm_templates
+from resilience import firestore_guard
+from reports import MAX_REPORT_MONTHS, report_months, summarize_rollups
+from query_registry import INDEXES_PATH, render_index_manifest, verify_data_layer, QUERY_SHAPES
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
 
+# Reuse compiled template bytecode across cold starts and worker boots
+configure_template_cache(app)
+
+# Compress HTML/JSON responses (Brotli when available, gzip otherwise)
+app.wsgi_app = CompressionMiddleware(app.wsgi_app)
+
 # Flask-Mail Configuration
 app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
 app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
-app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', True)
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'True').lower() in ('true', '1', 'yes')
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', 'fixfitponigeria@gmail.com')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', '')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', 'fixfitponigeria@gmail.com')
+# Bulk mail (reminders) re-opens its SMTP session after this many messages
+app.config['MAIL_MAX_EMAILS'] = int(os.environ.get('MAIL_MAX_EMAILS', 100))
 
 mail = Mail(app)
+reminder_sender = ReminderSender(mail)
+
+# Shed load on expensive routes before they tie up every worker thread
+admission_control.init_app(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# User class for Flask-Login compatibility
-class User(UserMixin):
+# Session principal for Flask-Login: loaded on every request, so it carries only
+# identity, role and display name. The full profile is fetched on the pages that show it.
+class Principal:
+    __slots__ = ('id', 'is_admin', 'first_name', 'last_name', '_profile')
+    
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+    
     def __init__(self, user_data):
         self.id = user_data['id']
-        self.email = user_data['email']
-        self.first_name = user_data['first_name']
-        self.last_name = user_data['last_name']
-        self.phone = user_data.get('phone')
-        self.patient_card_number = user_data.get('patient_card_number')
-        self.date_of_birth = user_data.get('date_of_birth')
-        self.address = user_data.get('address')
-        self.emergency_contact = user_data.get('emergency_contact')
-        self.emergency_phone = user_data.get('emergency_phone')
         self.is_admin = user_data.get('is_admin', False)
-        self.created_at = user_data.get('created_at')
-        self.password_hash = user_data['password_hash']
+        self.first_name = user_data.get('first_name', '')
+        self.last_name = user_data.get('last_name', '')
+        self._profile = None
     
     def get_id(self):
         return str(self.id)
     
-    @staticmethod
-    def get(user_id):
-        user_data = firebase_db.get_user_by_id(user_id)
-        if user_data:
-            return User(user_data)
-        return None
+    @property
+    def profile(self):
+        """Full profile fields (no password hash), read once per request on first use"""
+        if self._profile is None:
+            self._profile = firebase_db.get_user_profile(self.id) or {}
+        return self._profile
     
     @staticmethod
-    def get_by_email(email):
-        user_data = firebase_db.get_user_by_email(email)
-        if user_data:
-            return User(user_data)
-        return None
-    
-    @staticmethod
-    def get_by_patient_number(patient_number):
-        user_data = firebase_db.get_user_by_patient_number(patient_number)
+    def get(user_id):
+        user_data = firebase_db.get_user_principal(user_id)
         if user_data:
-            return User(user_data)
+            return Principal(user_data)
         return None
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get(user_id)
+    return Principal.get(user_id)
+
+@app.template_global()
+def attachment_variant_url(file_url, variant='thumbnail'):
+    """Template helper returning a precomputed attachment derivative URL"""
+    return cloudinary_storage.get_attachment_variant_url(file_url, variant)
 
 def admin_required(f):
     @wraps(f)
@@ -78,9 +108,40 @@ def admin_required(f):
         if not current_user.is_authenticated or not current_user.is_admin:
             flash('Access denied. Admin privileges required.', 'error')
             return redirect(url_for('index'))
-        return f(*args, **kwargs)
+        return app.ensure_sync(f)(*args, **kwargs)
     return decorated_function
 
+# Streamed pages: the shell and first rows are sent while later rows are still being read
+STREAM_CHUNK_SIZE = 16 * 1024
+
+def stream_page(template_name, **context):
+    """Render a template as a streamed HTML response, flushed in STREAM_CHUNK_SIZE pieces"""
+    def generate(chunks):
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield ''.join(buffer)
+    
+    # Flashes come out of the session, which is saved before the body is sent
+    get_flashed_messages()
+    return Response(generate(stream_template(template_name, **context)), mimetype='text/html',
+                    headers={'X-Accel-Buffering': 'no'})
+
+def rows_until_error(rows, errors):
+    """Yield rows from a Firestore stream; a failure part-way ends the table instead of the response"""
+    try:
+        yield from rows
+    except Exception as e:
+        print(f"Error streaming rows: {e}")
+        errors.append(str(e))
+
 # Routes
 @app.route('/')
 def index():
@@ -159,7 +220,7 @@ def register():
         emergency_phone = request.form.get('emergency_phone')
         patient_card_number = request.form.get('patient_card_number')
         
-        if User.get_by_email(email):
+        if firebase_db.get_user_by_email(email):
             flash('Email already registered', 'error')
             return render_template('register.html')
         
@@ -181,6 +242,8 @@ def register():
             flash('Registration failed. Please try again.', 'error')
             return render_template('register.html')
         
+        patient_search.add(user_data)
+        
         flash(f'Registration successful! Your patient number is: {user_data.get("patient_card_number", "N/A")}. Please login.', 'success')
         return redirect(url_for('login'))
     
@@ -196,15 +259,17 @@ def login():
             print(f"Login attempt with input: {login_input}")
             
             # Try to get user by email first, then by patient number
-            user = User.get_by_email(login_input)
-            if not user:
+            user_data = firebase_db.get_user_by_email(login_input)
+            if not user_data:
                 print(f"User not found by email, trying patient number")
-                user = User.get_by_patient_number(login_input)
+                user_data = firebase_db.get_user_by_patient_number(login_input)
             
-            if user:
-                print(f"User found: {user.email}, verifying password")
-                if firebase_db.verify_password(user.__dict__, password):
+            if user_data:
+                print(f"User found: {user_data['email']}, verifying password")
+                if firebase_db.verify_password(user_data, password):
                     print(f"Password verified, logging in user")
+                    # Only the principal outlives this block; the hash stays with user_data
+                    user = Principal(user_data)
                     login_user(user)
                     next_page = request.args.get('next')
                     if next_page:
@@ -234,14 +299,30 @@ def logout():
 
 @app.route('/dashboard')
 @login_required
-def dashboard():
-    appointments = firebase_db.get_appointments_by_user(current_user.id)
-    appointments.sort(key=lambda x: x.get('created_at', datetime.min), reverse=True)
-    recent_appointments = appointments[:5]  # Get 5 most recent
+async def dashboard():
+    # The timeline read and the local booking journal lookup are independent
+    profile, timeline, journal_bookings = await asyncio.gather(
+        async_firebase_db.get_user_profile(current_user.id),
+        async_firebase_db.get_patient_timeline(current_user.id),
+        asyncio.to_thread(booking_queue.for_user, current_user.id)
+    )
+    recent_appointments = timeline['appointments'][:5]  # Get 5 most recent
     
-    patient_history = firebase_db.get_patient_history(current_user.id)
+    # Write-behind bookings not yet in Firestore, and any that couldn't get their slot
+    queued = []
+    rejected = []
+    for booking in journal_bookings:
+        if booking['journal_status'] == 'pending':
+            queued.append(dict(booking, status='pending', queued=True))
+        else:
+            rejected.append(booking)
+            flash(f"We couldn't book your {booking['service']} appointment on {booking['date']} at {booking['time'][:5]}: "
+                  f"{booking['error'] if booking['journal_status'] == 'conflict' else 'please try booking again'}.", 'error')
+    if rejected:
+        booking_queue.journal.mark_notified([booking['key'] for booking in rejected])
+    recent_appointments = queued + recent_appointments
     
-    return render_template('dashboard.html', appointments=recent_appointments, patient_history=patient_history)
+    return render_template('dashboard.html', profile=profile or {}, appointments=recent_appointments, patient_history=timeline['diagnoses'])
 
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx'}
@@ -252,14 +333,37 @@ def allowed_file(filename):
 def book_appointment():
     if request.method == 'POST':
         service_type = request.form['service_type']
-        appointment_date = datetime.strptime(request.form['appointment_date'], '%Y-%m-%dT%H:%M')
+        try:
+            if request.form.get('appointment_day'):
+                appointment_date = datetime.strptime(f"{request.form['appointment_day']}T{request.form.get('appointment_slot', '')}", '%Y-%m-%dT%H:%M')
+            else:
+                appointment_date = datetime.strptime(request.form['appointment_date'], '%Y-%m-%dT%H:%M')
+        except ValueError:
+            flash('Please choose a date and one of the available time slots.', 'error')
+            return render_template('book_appointment.html', slot_minutes=SLOT_MINUTES)
         notes = request.form.get('notes', '')
         
+        if appointment_date <= datetime.now():
+            flash('Please choose a time in the future.', 'error')
+            return render_template('book_appointment.html', slot_minutes=SLOT_MINUTES)
+        
         # Handle file upload
         attachment_url = None
         attachment_filename = None
         
-        if 'attachment' in request.files:
+        if request.form.get('attachment_public_id'):
+            # Uploaded by the browser straight to Cloudinary; only verify and store the reference
+            try:
+                attachment_url = cloudinary_storage.verify_direct_upload(
+                    current_user.id,
+                    public_id=request.form['attachment_public_id'],
+                    version=request.form.get('attachment_version'),
+                    signature=request.form.get('attachment_signature')
+                )
+                attachment_filename = secure_filename(request.form.get('attachment_filename', '')) or None
+            except ValueError as e:
+                flash(f'Error attaching file: {str(e)}', 'error')
+        elif 'attachment' in request.files:
             file = request.files['attachment']
             if file and file.filename != '' and allowed_file(file.filename):
                 try:
@@ -282,25 +386,71 @@ def book_appointment():
         print(f"Booking appointment for user ID: {current_user.id}")
         print(f"Service: {service_type}, Date: {appointment_date.date()}, Time: {appointment_date.time()}")
         
-        appointment = firebase_db.create_appointment(
-            user_id=current_user.id,
-            service=service_type,
-            date=appointment_date.date(),
-            time=appointment_date.time(),
-            notes=notes,
-            attachment_url=attachment_url,
-            attachment_filename=attachment_filename
-        )
+        if booking_queue.enabled:
+            # Write-behind: acknowledge once journaled; the slot is claimed in Firestore shortly after
+            booking_queue.submit(
+                user_id=current_user.id,
+                service=service_type,
+                date=appointment_date.date(),
+                time=appointment_date.time(),
+                notes=notes,
+                attachment_url=attachment_url,
+                attachment_filename=attachment_filename
+            )
+            flash("Appointment request received! We'll confirm your time slot shortly.", 'success')
+            return redirect(url_for('dashboard'))
+        
+        try:
+            appointment = firebase_db.book_appointment_slot(
+                user_id=current_user.id,
+                service=service_type,
+                date=appointment_date.date(),
+                time=appointment_date.time(),
+                notes=notes,
+                attachment_url=attachment_url,
+                attachment_filename=attachment_filename
+            )
+        except SlotUnavailableError as e:
+            flash(f'{e}. Please pick another time.', 'error')
+            return render_template('book_appointment.html', slot_minutes=SLOT_MINUTES)
         
         if not appointment:
             flash('Failed to book appointment. Please try again.', 'error')
-            return render_template('book_appointment.html')
+            return render_template('book_appointment.html', slot_minutes=SLOT_MINUTES)
         
         print(f"Appointment created successfully: {appointment}")
         flash('Appointment booked successfully!', 'success')
         return redirect(url_for('dashboard'))
     
-    return render_template('book_appointment.html')
+    return render_template('book_appointment.html', slot_minutes=SLOT_MINUTES)
+
+@app.route('/appointments/upload-signature', methods=['POST'])
+@login_required
+def appointment_upload_signature():
+    """Signed parameters for uploading an attachment directly from the browser to Cloudinary"""
+    filename = secure_filename((request.get_json(silent=True) or {}).get('filename', ''))
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    if not cloudinary_storage.initialized:
+        # The form falls back to posting the file through the app
+        return jsonify({'error': 'Direct uploads are not available'}), 503
+    
+    return jsonify(cloudinary_storage.sign_direct_upload(current_user.id, filename, folder='appointments'))
+
+@app.route('/appointments/availability')
+@login_required
+def appointment_availability():
+    """Free/booked slots for one day and service, answered from a single slot document"""
+    service = request.args.get('service', '').strip()
+    try:
+        day = datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Expected date=YYYY-MM-DD'}), 400
+    if not service:
+        return jsonify({'error': 'Missing service'}), 400
+    
+    booked_mask = firebase_db.get_slot_mask(day, service)
+    return jsonify({'date': day.isoformat(), 'service': service, 'slots': describe_slots(day, booked_mask)})
 
 @app.route('/education')
 def education():
@@ -312,13 +462,15 @@ def education():
 @app.route('/admin/dashboard')
 @login_required
 @admin_required
-def admin_dashboard():
+async def admin_dashboard():
     print("Admin Dashboard: Loading data...")
-    total_users = firebase_db.get_user_count()
-    total_appointments = firebase_db.get_appointment_count()
-    pending_appointments = firebase_db.get_pending_appointments_count()
-    recent_appointments = firebase_db.get_recent_appointments(5)
-    recent_users = firebase_db.get_all_users()[:5]  # Get first 5 users
+    total_users, total_appointments, pending_appointments, recent_appointments, recent_users = await asyncio.gather(
+        async_firebase_db.get_user_count(),
+        async_firebase_db.get_appointment_count(include_archived=True),
+        async_firebase_db.get_pending_appointments_count(),
+        async_firebase_db.get_recent_appointments(5),
+        async_firebase_db.get_all_users(limit=5)
+    )
     
     print(f"Admin Dashboard: Stats - Users: {total_users}, Appointments: {total_appointments}, Pending: {pending_appointments}")
     print(f"Admin Dashboard: Recent appointments count: {len(recent_appointments)}")
@@ -335,15 +487,158 @@ def admin_dashboard():
 @login_required
 @admin_required
 def admin_users():
-    users = firebase_db.get_all_users()
-    return render_template('admin/users.html', users=users)
+    load_errors = []
+    users = rows_until_error(firebase_db.stream_users(), load_errors)
+    return stream_page('admin/users.html', users=users, load_errors=load_errors)
+
+@app.route('/admin/users/search')
+@login_required
+@admin_required
+def admin_search_users():
+    """Typeahead search over name, email, phone and patient card number"""
+    query = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    
+    patient_search.ensure_built()
+    results = patient_search.search(query, limit=limit) if query else []
+    return jsonify({
+        'query': query,
+        'results': [dict(result, url=url_for('admin_view_user', user_id=result['id'])) for result in results]
+    })
 
 @app.route('/admin/appointments')
 @login_required
 @admin_required
 def admin_appointments():
-    appointments = firebase_db.get_all_appointments()
-    return render_template('admin/appointments.html', appointments=appointments)
+    # Serve from the live materialized view once its listener is up
+    appointment_feed.start()
+    load_errors = []
+    if appointment_feed.is_live():
+        appointments = appointment_feed.get_appointments()
+    else:
+        appointments = rows_until_error(firebase_db.stream_appointment_rows(), load_errors)
+    return stream_page('admin/appointments.html', appointments=appointments, load_errors=load_errors)
+
+@app.route('/admin/appointments/stream')
+@login_required
+@admin_required
+def admin_appointments_stream():
+    """Server-Sent Events feed of appointment changes for the admin table"""
+    if not appointment_feed.start():
+        return '', 204
+    
+    # EventSource sends the id of the last event it saw when it reconnects
+    try:
+        last_position = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_position = None
+    
+    subscriber = appointment_feed.subscribe(last_position)
+    if subscriber is None:
+        # Every stream slot in this worker is taken; the browser tries again later
+        return Response('retry: 30000\n\n', mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    
+    deadline = time.monotonic() + APPOINTMENT_FEED_STREAM_SECONDS
+    
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            if last_position is None and appointment_feed.position is not None:
+                yield f"id: {appointment_feed.position}\n\n"
+            # End the stream periodically so it frees its worker thread; the browser reconnects and resumes
+            while time.monotonic() < deadline:
+                try:
+                    event = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # Restarts the listener if it died, which tells every stream to resync
+                    appointment_feed.start()
+                    yield ': keepalive\n\n'
+                    continue
+                
+                if event['type'] == 'resync':
+                    yield 'event: resync\ndata: {}\n\n'
+                    return
+                
+                payload = {'type': event['type'], 'id': event['id']}
+                if event['type'] != 'removed':
+                    payload['html'] = render_template('admin/_appointment_row.html', appointment=event['appointment'])
+                event_id = f"id: {event['position']}\n" if event.get('last') else ''
+                yield f"{event_id}event: appointment\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            appointment_feed.unsubscribe(subscriber)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def parse_export_filters():
+    """Read the shared export query-string filters"""
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return None
+    
+    filters = {'status': request.args.get('status') or None}
+    for key in ('start_date', 'end_date'):
+        value = request.args.get(key)
+        filters[key] = datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    return export_format, filters
+
+def export_response(rows, fields, export_format, name):
+    """Stream rows to the client as a chunked download"""
+    generate, mimetype = EXPORT_FORMATS[export_format]
+    filename = f"{name}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.{export_format}"
+    return Response(
+        stream_with_context(generate(rows, fields)),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@app.route('/admin/export/appointments')
+@login_required
+@admin_required
+def export_appointments():
+    try:
+        parsed = parse_export_filters()
+    except ValueError:
+        return 'Invalid date filter, expected YYYY-MM-DD', 400
+    if not parsed:
+        return 'Unsupported export format', 400
+    
+    export_format, filters = parsed
+    appointments = firebase_db.stream_appointments(**filters)
+    if request.args.get('archived', '1') != '0':
+        # Archived appointments are all older than live ones, so chaining keeps date order
+        appointments = itertools.chain(firebase_db.stream_archived_appointments(**filters), appointments)
+    rows = join_patients(appointments, PatientLookup(firebase_db))
+    return export_response(rows, APPOINTMENT_EXPORT_FIELDS, export_format, 'appointments')
+
+@app.route('/admin/export/patient-histories')
+@login_required
+@admin_required
+def export_patient_histories():
+    try:
+        parsed = parse_export_filters()
+    except ValueError:
+        return 'Invalid date filter, expected YYYY-MM-DD', 400
+    if not parsed:
+        return 'Unsupported export format', 400
+    
+    export_format, filters = parsed
+    user_id = request.args.get('user_id') or None
+    rows = join_patients(firebase_db.stream_diagnoses(user_id=user_id, **filters), PatientLookup(firebase_db))
+    return export_response(rows, DIAGNOSIS_EXPORT_FIELDS, export_format, 'patient-histories')
+
+@app.route('/admin/reports')
+@login_required
+@admin_required
+def admin_reports():
+    """Clinic analytics answered from the monthly report_rollups documents"""
+    month_count = max(1, min(request.args.get('months', 12, type=int), MAX_REPORT_MONTHS))
+    rollups = firebase_db.get_report_rollups(tuple(report_months(month_count)))
+    return render_template('admin/reports.html', report=summarize_rollups(rollups), month_count=month_count)
 
 @app.route('/admin/settings')
 @login_required
@@ -351,6 +646,19 @@ def admin_appointments():
 def admin_settings():
     return render_template('admin/settings.html')
 
+@app.route('/admin/metrics')
+@login_required
+@admin_required
+def admin_metrics():
+    """Runtime metrics for this worker process"""
+    return jsonify({
+        'pid': os.getpid(),
+        'admission': admission_control.stats(),
+        'firestore': firestore_guard.stats(),
+        'booking_queue': booking_queue.stats() if booking_queue.enabled else None,
+        'templates': {key: value for key, value in app.extensions.get('template_warmup', {}).items() if key != 'timings'}
+    })
+
 @app.route('/admin/update_appointment_status/<appointment_id>/<status>')
 @login_required
 def update_appointment_status(appointment_id, status):
@@ -358,27 +666,125 @@ def update_appointment_status(appointment_id, status):
         flash('Access denied', 'error')
         return redirect(url_for('dashboard'))
     
-    success = firebase_db.update_appointment_status(appointment_id, status)
+    try:
+        success = firebase_db.update_appointment_status(appointment_id, status)
+    except InvalidStatusTransitionError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin_appointments'))
     if success:
         flash('Appointment status updated', 'success')
     else:
         flash('Failed to update appointment status', 'error')
     return redirect(url_for('admin_appointments'))
 
+BULK_APPOINTMENT_STATUSES = {'confirmed', 'cancelled', 'completed'}
+
+@app.route('/admin/appointments/bulk-status', methods=['POST'])
+@login_required
+@admin_required
+def bulk_update_appointment_status():
+    """Apply one status to many selected appointments using batched writes"""
+    status = request.form.get('status')
+    appointment_ids = [appointment_id for appointment_id in request.form.getlist('appointment_ids') if appointment_id]
+    
+    if status not in BULK_APPOINTMENT_STATUSES:
+        flash('Invalid status', 'error')
+        return redirect(url_for('admin_appointments'))
+    if not appointment_ids:
+        flash('Select at least one appointment', 'error')
+        return redirect(url_for('admin_appointments'))
+    
+    result = firebase_db.bulk_update_appointment_status(appointment_ids, status)
+    if result['updated']:
+        flash(f"{len(result['updated'])} appointment(s) marked {status}", 'success')
+    if result['failed']:
+        details = ', '.join(f"{appointment_id} ({reason})" for appointment_id, reason in list(result['failed'].items())[:5])
+        more = len(result['failed']) - 5
+        flash(f"{len(result['failed'])} appointment(s) could not be updated: {details}{f' and {more} more' if more > 0 else ''}", 'error')
+    return redirect(url_for('admin_appointments'))
+
+APPOINTMENT_STATUSES = {'pending', 'confirmed', 'completed', 'cancelled'}
+DIAGNOSIS_STATUSES = {'active', 'resolved'}
+
+def requested_status():
+    """Status from a JSON body or form post"""
+    data = request.get_json(silent=True) or request.form
+    return data.get('status')
+
+@app.route('/admin/api/appointments/<appointment_id>')
+@login_required
+@admin_required
+def api_appointment_detail(appointment_id):
+    """Full appointment record (including notes) for the details modal"""
+    appointment = firebase_db.get_appointment_by_id(appointment_id)
+    if not appointment:
+        return jsonify({'error': 'Appointment not found'}), 404
+    
+    return jsonify({'appointment': {
+        'id': appointment['id'],
+        'status': appointment.get('status'),
+        'notes': appointment.get('notes') or '',
+        'updated_at': appointment['updated_at'].isoformat() if appointment.get('updated_at') else None
+    }})
+
+@app.route('/admin/api/appointments/<appointment_id>/status', methods=['POST'])
+@login_required
+@admin_required
+def api_update_appointment_status(appointment_id):
+    """Change one appointment's status and return just the updated record and row fragments"""
+    status = requested_status()
+    if status not in APPOINTMENT_STATUSES:
+        return jsonify({'error': 'Invalid status'}), 400
+    
+    try:
+        updated = firebase_db.update_appointment_status(appointment_id, status)
+    except InvalidStatusTransitionError as e:
+        return jsonify({'error': str(e)}), 409
+    if not updated:
+        return jsonify({'error': 'Failed to update appointment status'}), 500
+    
+    status_badge = get_template_attribute('admin/_appointment_macros.html', 'status_badge')
+    status_actions = get_template_attribute('admin/_appointment_macros.html', 'status_actions')
+    return jsonify({
+        'appointment': {'id': appointment_id, 'status': status, 'updated_at': datetime.utcnow().isoformat()},
+        'html': {
+            'status_badge': str(status_badge(status)),
+            'status_actions': str(status_actions(appointment_id, status))
+        }
+    })
+
+@app.route('/admin/api/diagnoses/<diagnosis_id>/status', methods=['POST'])
+@login_required
+@admin_required
+def api_update_diagnosis_status(diagnosis_id):
+    """Change one diagnosis' status and return just the updated record"""
+    status = requested_status()
+    if status not in DIAGNOSIS_STATUSES:
+        return jsonify({'error': 'Invalid status'}), 400
+    
+    if not firebase_db.update_diagnosis_status(diagnosis_id, status):
+        return jsonify({'error': 'Failed to update diagnosis status'}), 500
+    
+    return jsonify({'diagnosis': {'id': diagnosis_id, 'status': status, 'updated_at': datetime.utcnow().isoformat()}})
+
 @app.route('/admin/user/<user_id>')
 @login_required
-def admin_view_user(user_id):
+async def admin_view_user(user_id):
     if not current_user.is_admin:
         flash('Access denied', 'error')
         return redirect(url_for('dashboard'))
     
-    user = firebase_db.get_user_by_id(user_id)
+    # Fetch the patient and their history together; the timeline is discarded if the user doesn't exist
+    user, timeline = await asyncio.gather(
+        async_firebase_db.get_user_by_id(user_id),
+        async_firebase_db.get_patient_timeline(user_id)
+    )
     if not user:
         flash('User not found', 'error')
         return redirect(url_for('admin_users'))
     
     # Get patient history
-    patient_history = firebase_db.get_patient_history(user_id)
+    patient_history = timeline['diagnoses']
     
     return render_template('admin/view_user.html', user=user, patient_history=patient_history)
 
@@ -456,6 +862,8 @@ def edit_patient_details(user_id):
         )
         
         if success:
+            appointment_feed.invalidate_user(user_id)
+            patient_search.update(user_id, first_name=first_name, last_name=last_name, email=email, phone=phone)
             flash('Patient details updated successfully', 'success')
             return redirect(url_for('admin_view_user', user_id=user_id))
         else:
@@ -478,6 +886,40 @@ def update_diagnosis_status(diagnosis_id, status):
     
     return '', 200
 
+# Scheduled tasks (Vercel Cron)
+def cron_required(f):
+    """Scheduled-task endpoints: Vercel Cron sends `Authorization: Bearer $CRON_SECRET`"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        cron_secret = os.environ.get('CRON_SECRET')
+        if not cron_secret:
+            return 'Not found', 404
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {cron_secret}'):
+            return 'Unauthorized', 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.route('/tasks/archive-appointments')
+@cron_required
+def archive_appointments_task():
+    """Scheduled archive job"""
+    # Bounded per run so one invocation stays within the function time limit
+    archived = firebase_db.archive_appointments(max_chunks=int(os.environ.get('ARCHIVE_MAX_CHUNKS', 25)))
+    return jsonify({'archived': archived})
+
+@app.route('/tasks/send-reminders')
+@cron_required
+def send_reminders_task():
+    """Scheduled reminder job; runs several times a day and resumes where the last run stopped"""
+    stats = reminder_sender.send_for_day(max_messages=int(os.environ.get('REMINDER_MAX_PER_RUN', 500)))
+    return jsonify(stats)
+
+@app.route('/tasks/gc-attachments')
+@cron_required
+def gc_attachments_task():
+    """Scheduled clean-up of Cloudinary attachments no appointment references"""
+    return jsonify(collect_orphaned_attachments())
+
 # Redirect routes for cPanel and Webmail
 @app.route('/cpanel')
 def cpanel():
@@ -495,6 +937,7 @@ def create_admin_user():
         if admin:
             print("Deleting existing admin user")
             firebase_db.db.collection('users').document(admin['id']).delete()
+            patient_search.remove(admin['id'])
         
         # Create fresh admin user
         admin_data = firebase_db.create_user(
@@ -506,6 +949,7 @@ def create_admin_user():
             is_admin=True
         )
         if admin_data:
+            patient_search.add(admin_data)
             print("NEW Admin user created: admin@fixandfit.com / admin123")
         else:
             print("Failed to create admin user")
@@ -515,5 +959,98 @@ def create_admin_user():
 # Create admin user on startup if none exists
 create_admin_user()
 
+# Compile every template now (in the gunicorn master with preload_app) instead of on first hit
+if TEMPLATE_WARMUP:
+    warm_templates(app)
+
+@app.cli.command('backfill-notes-previews')
+def backfill_notes_previews_command():
+    """Store notes_preview on appointments created before list projections"""
+    updated = firebase_db.backfill_notes_previews()
+    print(f"Updated {updated} appointments")
+
+@app.cli.command('backfill-appointment-slots')
+def backfill_appointment_slots_command():
+    """Mark upcoming appointments booked before slot bitmaps as taken (run once after deploying them)"""
+    claimed = firebase_db.backfill_appointment_slots()
+    print(f"Claimed slots for {claimed} appointments")
+
+@app.cli.command('archive-appointments')
+@click.option('--days', type=int, default=None, help='Archive appointments dated more than this many days ago.')
+@click.option('--dry-run', is_flag=True, help='Only count the appointments that would be archived.')
+def archive_appointments_command(days, dry_run):
+    """Move old appointments into the monthly archive partitions"""
+    count = firebase_db.archive_appointments(older_than_days=days, dry_run=dry_run)
+    print(f"{'Would archive' if dry_run else 'Archived'} {count} appointments")
+
+@app.cli.command('send-reminders')
+@click.option('--date', 'day', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='Appointment date to remind (default: tomorrow).')
+@click.option('--dry-run', is_flag=True, help='Only count the appointments that would be reminded.')
+def send_reminders_command(day, dry_run):
+    """Email reminders for one day's appointments"""
+    stats = reminder_sender.send_for_day(day.date() if day else None, dry_run=dry_run)
+    print(json.dumps(stats))
+
+@app.cli.command('gc-attachments')
+@click.option('--grace-hours', type=int, default=None, help='Never delete uploads younger than this.')
+@click.option('--dry-run', is_flag=True, help='Only count orphaned attachments.')
+def gc_attachments_command(grace_hours, dry_run):
+    """Delete Cloudinary attachments that no appointment references"""
+    stats = collect_orphaned_attachments(grace_hours=grace_hours, dry_run=dry_run)
+    print(json.dumps(stats))
+
+@app.cli.command('precompile-templates')
+def precompile_templates_command():
+    """Compile every template into the bytecode cache (run at deploy time)"""
+    # Start from an empty in-memory cache so every template goes through the bytecode cache
+    app.jinja_env.cache.clear()
+    warm_templates(app)
+    print(f"Bytecode cache: {app.jinja_env.bytecode_cache.directory}")
+
+@app.cli.command('flush-bookings')
+@click.option('--requeue-failed', is_flag=True, help='Retry bookings that exhausted their attempts.')
+def flush_bookings_command(requeue_failed):
+    """Commit every due write-behind booking to Firestore now"""
+    if requeue_failed:
+        print(f"Requeued {booking_queue.journal.requeue_failed()} failed bookings")
+    processed = booking_queue.drain()
+    print(f"Processed {processed} bookings")
+    print(json.dumps(booking_queue.stats()))
+
+@app.cli.command('rebuild-report-rollups')
+def rebuild_report_rollups_command():
+    """Recount the reporting rollups from every live and archived appointment (pause writes first)"""
+    months = firebase_db.rebuild_report_rollups()
+    print(f"Rebuilt {months} monthly rollups")
+
+@app.cli.command('firestore-indexes')
+@click.option('--check', is_flag=True, help='Fail if firestore.indexes.json is out of date instead of writing it.')
+def firestore_indexes_command(check):
+    """Generate firestore.indexes.json from the query registry"""
+    manifest = render_index_manifest()
+    if check:
+        current = open(INDEXES_PATH).read() if os.path.exists(INDEXES_PATH) else None
+        if current != manifest:
+            raise click.ClickException(f"{INDEXES_PATH} is out of date; run `flask --app app firestore-indexes`")
+        print(f"{INDEXES_PATH} is up to date")
+        return
+    with open(INDEXES_PATH, 'w') as f:
+        f.write(manifest)
+    print(f"Wrote {INDEXES_PATH}")
+
+@app.cli.command('verify-queries')
+@click.option('--live', is_flag=True, help='Run the probes against Firestore (or the emulator) instead of a dry run.')
+def verify_queries_command(live):
+    """Check every data-layer query against the registry: registered shape, and bounded unless declared"""
+    verifier = verify_data_layer(firebase_db, async_firebase_db, dry_run=not live)
+    for label, issued, problem in verifier.violations:
+        print(f"FAIL {label}: {problem}: {json.dumps(issued)}")
+    not_exercised = sorted({shape.name for shape in QUERY_SHAPES} - verifier.exercised())
+    print(f"{len(verifier.issued)} queries checked, {len(verifier.violations)} violations, {len(verifier.errors)} probe errors")
+    if not_exercised:
+        print(f"Not exercised: {', '.join(not_exercised)}")
+    if verifier.violations or verifier.errors:
+        raise SystemExit(1)
+
 if __name__ == '__main__':
     app.run(debug=True)
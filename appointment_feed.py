@@ -0,0 +1,209 @@
+import os
+import queue
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from firebase_db import firebase_db, notes_preview
+
+# Each open SSE stream holds a gunicorn thread, so a worker serves only an eighth of its threads
+APPOINTMENT_FEED_MAX_SUBSCRIBERS = int(os.environ.get('APPOINTMENT_FEED_MAX_SUBSCRIBERS',
+                                                      max(1, int(os.environ.get('GUNICORN_THREADS', 8)) // 8)))
+# Streams end after this many seconds; the browser reconnects and resumes from its last event
+APPOINTMENT_FEED_STREAM_SECONDS = int(os.environ.get('APPOINTMENT_FEED_STREAM_SECONDS', 300))
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = datetime.resolution
+
+
+class AppointmentFeed:
+    """Materialized view of all appointments kept current by a Firestore snapshot listener"""
+
+    def __init__(self, db=None, max_pending_events=256, max_subscribers=None):
+        self.firebase_db = db or firebase_db
+        self.max_pending_events = max_pending_events
+        self.max_subscribers = max_subscribers or APPOINTMENT_FEED_MAX_SUBSCRIBERS
+        self.enabled = os.environ.get('APPOINTMENT_FEED_ENABLED', '0' if os.environ.get('VERCEL') else '1') == '1'
+        self.ready = threading.Event()
+        # Position of the latest applied snapshot (its read time in microseconds, the same
+        # in every worker), and recent events so a reconnecting stream can catch up
+        self.position = None
+        self._recent = deque()
+        self._replay_from = None
+        self._appointments = {}
+        self._users = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._watch = None
+
+    def start(self):
+        """Start listening to the appointments collection (idempotent); restarts a listener that died"""
+        if not self.enabled or not self.firebase_db.db:
+            return False
+
+        with self._lock:
+            watch = self._watch
+        if watch is not None and not watch.is_active:
+            # The listener closed on an unrecoverable error; rebuild the view from a new one
+            print("Appointment feed: snapshot listener stopped, restarting")
+            self.stop()
+
+        with self._lock:
+            if self._watch is not None:
+                return True
+            try:
+                self._watch = self.firebase_db.db.collection('appointments').on_snapshot(self._on_snapshot)
+                print("Appointment feed: snapshot listener started")
+                return True
+            except Exception as e:
+                print(f"Error starting appointment feed: {e}")
+                self._watch = None
+                return False
+
+    def stop(self):
+        """Stop the snapshot listener and drop the materialized view"""
+        with self._lock:
+            if self._watch is not None:
+                try:
+                    self._watch.unsubscribe()
+                except Exception as e:
+                    print(f"Error stopping appointment feed: {e}")
+            self._watch = None
+            self._appointments = {}
+            self._users = {}
+            self.position = None
+            self._recent.clear()
+            self._replay_from = None
+            subscribers = list(self._subscribers)
+        self.ready.clear()
+
+        # Tell connected browsers their view is no longer being maintained
+        for subscriber in subscribers:
+            self._offer(subscriber, {'type': 'resync'})
+
+    def is_live(self):
+        """True once the initial snapshot has been applied, while the listener is running"""
+        watch = self._watch
+        return watch is not None and watch.is_active and self.ready.is_set()
+
+    def get_appointments(self):
+        """Return the current view, most recently created first"""
+        with self._lock:
+            appointments = list(self._appointments.values())
+        appointments.sort(key=lambda x: x.get('created_at') or datetime.min, reverse=True)
+        return appointments
+
+    def subscribe(self, last_position=None):
+        """Register a subscriber queue that receives change events, or None if this worker is full.
+
+        A reconnecting stream passes the position of the last event it saw; it is sent the
+        events since then, or told to resync if they are no longer (or never were) held here.
+        """
+        subscriber = queue.Queue(maxsize=self.max_pending_events)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            if last_position is not None:
+                if self._replay_from is None or last_position < self._replay_from:
+                    subscriber.put_nowait({'type': 'resync'})
+                else:
+                    for event in self._recent:
+                        if event['position'] > last_position:
+                            subscriber.put_nowait(event)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def invalidate_user(self, user_id):
+        """Forget a cached user so the next change picks up fresh profile details"""
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        self._prefetch_users((change.document.to_dict() or {}).get('user_id') for change in changes
+                             if change.type.name.lower() != 'removed')
+        position = (read_time - _EPOCH) // _MICROSECOND
+
+        events = []
+        for change in changes:
+            doc = change.document
+            change_type = change.type.name.lower()
+            if change_type == 'removed':
+                with self._lock:
+                    self._appointments.pop(doc.id, None)
+                events.append({'type': 'removed', 'id': doc.id})
+                continue
+
+            # Keep only the list fields (not full notes) for every appointment in every worker
+            data = doc.to_dict()
+            appointment_data = self.firebase_db.AppointmentRow(doc.id, data)
+            if appointment_data.notes_preview is None:
+                appointment_data.notes_preview = notes_preview(data.get('notes'))
+            appointment_data.user = self._get_user(appointment_data.user_id)
+            with self._lock:
+                self._appointments[doc.id] = appointment_data
+            events.append({'type': change_type, 'id': doc.id, 'appointment': appointment_data})
+
+        if not self.ready.is_set():
+            # The first callback carries the whole collection; the page render covers it
+            with self._lock:
+                self.position = self._replay_from = position
+            self.ready.set()
+            print(f"Appointment feed: initial snapshot with {len(docs)} appointments")
+            return
+
+        for event in events:
+            event['position'] = position
+        if events:
+            # Streams send the position with a snapshot's last event, so a resumed one never gets half a snapshot
+            events[-1]['last'] = True
+        with self._lock:
+            self.position = position
+            self._recent.extend(events)
+            while len(self._recent) > self.max_pending_events:
+                self._replay_from = self._recent.popleft()['position']
+            subscribers = list(self._subscribers)
+        for event in events:
+            for subscriber in subscribers:
+                self._offer(subscriber, event)
+
+    def _get_user(self, user_id):
+        if not user_id:
+            return None
+        with self._lock:
+            if user_id in self._users:
+                return self._users[user_id]
+        user_data = self.firebase_db.get_user_summaries([user_id]).get(user_id)
+        with self._lock:
+            self._users[user_id] = user_data
+        return user_data
+
+    def _prefetch_users(self, user_ids):
+        """Load every uncached patient for a snapshot in one batched read"""
+        with self._lock:
+            missing = {user_id for user_id in user_ids if user_id and user_id not in self._users}
+        if not missing:
+            return
+        users = self.firebase_db.get_user_summaries(missing)
+        with self._lock:
+            for user_id in missing:
+                self._users[user_id] = users.get(user_id)
+
+    def _offer(self, subscriber, event):
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            # Slow client: replace its backlog with a single resync request
+            with self._lock:
+                self._subscribers.discard(subscriber)
+            try:
+                while True:
+                    subscriber.get_nowait()
+            except queue.Empty:
+                pass
+            subscriber.put_nowait({'type': 'resync'})
+
+# Global instance
+appointment_feed = AppointmentFeed()
@@ -0,0 +1,225 @@
+import os
+import asyncio
+import threading
+from functools import wraps
+import firebase_admin
+from google.cloud import firestore as gcloud_firestore
+from firebase_db import firebase_db
+from resilience import async_read_operation
+
+
+def _on_client_loop(method):
+    """Run the coroutine on the data layer's own event loop, where its AsyncClient lives"""
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self._submit(method(self, *args, **kwargs))
+    return wrapper
+
+
+class AsyncFirebaseDB:
+    """Coroutine version of FirebaseDB on firestore.AsyncClient.
+
+    Flask runs each async view on a short-lived event loop, while a gRPC channel is
+    bound to the loop that opened it; so the client lives on one long-running loop per
+    process and views await their queries there. The read paths behind the dashboards
+    are native; any other FirebaseDB method is available too and runs in a thread.
+    """
+
+    def __init__(self, sync_db=None):
+        self.sync = sync_db or firebase_db
+        self.db = None
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == 'sync':
+            raise AttributeError(name)
+        attr = getattr(self.sync, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        async def in_thread(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+        return in_thread
+
+    def _client_loop(self):
+        # Threads and channels don't survive fork, so each worker process starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='firestore-async', daemon=True).start()
+                self.db = self._create_client()
+                self._pid = os.getpid()
+            return self._loop
+
+    def _create_client(self):
+        if not firebase_admin._apps or self.sync.db is None:
+            return None
+        try:
+            app = firebase_admin.get_app()
+            return gcloud_firestore.AsyncClient(credentials=app.credential.get_credential(), project=app.project_id)
+        except Exception as e:
+            print(f"Error creating async Firestore client: {e}")
+            return None
+
+    async def _submit(self, coro):
+        loop = self._client_loop()
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    # Users
+    @async_read_operation(stale=False)
+    @_on_client_loop
+    async def get_user_by_id(self, user_id):
+        """Get user by document ID"""
+        if not self.db:
+            return None
+
+        user_doc = await self.db.collection('users').document(user_id).get()
+        if user_doc.exists:
+            user_data = user_doc.to_dict()
+            user_data['id'] = user_doc.id
+            return user_data
+        return None
+
+    @async_read_operation()
+    @_on_client_loop
+    async def get_user_profile(self, user_id):
+        """A user's profile fields, without the password hash"""
+        if not self.db:
+            return None
+
+        user_doc = await self.db.collection('users').document(user_id).get(field_paths=self.sync.PROFILE_FIELDS)
+        if user_doc.exists:
+            user_data = user_doc.to_dict()
+            user_data['id'] = user_doc.id
+            return user_data
+        return None
+
+    @async_read_operation(default=list)
+    @_on_client_loop
+    async def get_all_users(self, limit=None):
+        """Get all users as lightweight rows (no password hashes), newest first"""
+        if not self.db:
+            return []
+
+        query = (self.db.collection('users')
+                 .select(self.sync.USER_LIST_FIELDS)
+                 .order_by('created_at', direction=gcloud_firestore.Query.DESCENDING))
+        if limit:
+            query = query.limit(limit)
+        return [self.sync.UserRow(doc.id, doc.to_dict()) async for doc in query.stream()]
+
+    @async_read_operation(default=dict, stale=False)
+    @_on_client_loop
+    async def get_user_summaries(self, user_ids):
+        """Fetch name/email summaries for many users in one batched read"""
+        if not self.db:
+            return {}
+        return await self._user_summaries(user_ids)
+
+    async def _user_summaries(self, user_ids):
+        user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id]
+        if not user_ids:
+            return {}
+
+        refs = [self.db.collection('users').document(user_id) for user_id in user_ids]
+        return {
+            snapshot.id: self.sync.UserSummary(snapshot.id, snapshot.to_dict())
+            async for snapshot in self.db.get_all(refs, field_paths=self.sync.USER_SUMMARY_FIELDS)
+            if snapshot.exists
+        }
+
+    # Patient Timelines
+    @async_read_operation(default=lambda: {kind: [] for kind in firebase_db.TIMELINE_FIELDS})
+    @_on_client_loop
+    async def get_patient_timeline(self, user_id):
+        """A patient's recent appointments and diagnoses, newest first, from one document read"""
+        if not self.db:
+            return {kind: [] for kind in self.sync.TIMELINE_FIELDS}
+
+        snapshot = await self.db.collection('patient_timelines').document(user_id).get()
+        data = snapshot.to_dict() if snapshot.exists else {}
+        if not data.get('built_at'):
+            # Rare one-off per patient; reuse the sync transaction rather than duplicate it
+            print(f"Firebase: Building timeline for user {user_id}")
+            data = await asyncio.to_thread(self.sync.rebuild_patient_timeline, user_id)
+        return {kind: self.sync._timeline_events(data.get(kind)) for kind in self.sync.TIMELINE_FIELDS}
+
+    # Appointments
+    @async_read_operation(default=list)
+    @_on_client_loop
+    async def get_recent_appointments(self, limit=5):
+        """Get recent appointments"""
+        if not self.db:
+            return []
+
+        query = (self.db.collection('appointments')
+                 .select(self.sync.APPOINTMENT_LIST_FIELDS)
+                 .order_by('created_at', direction=gcloud_firestore.Query.DESCENDING)
+                 .limit(limit))
+        appointments = [self.sync.AppointmentRow(doc.id, doc.to_dict()) async for doc in query.stream()]
+        users = await self._user_summaries(appointment['user_id'] for appointment in appointments)
+        for appointment in appointments:
+            appointment['user'] = users.get(appointment['user_id'])
+        return appointments
+
+    @async_read_operation(default=list)
+    @_on_client_loop
+    async def get_archive_months(self):
+        """Archive partitions, newest first: [{'month': 'YYYY-MM', 'count': n}]"""
+        if not self.db:
+            return []
+        return await self._archive_months()
+
+    async def _archive_months(self):
+        months = [{'month': doc.id, 'count': doc.to_dict().get('count', 0)}
+                  async for doc in self.db.collection('appointment_archive').stream()]
+        months.sort(key=lambda partition: partition['month'], reverse=True)
+        return months
+
+    @async_read_operation(default=0)
+    @_on_client_loop
+    async def get_archived_appointment_count(self):
+        """Total archived appointments, from the per-month counters"""
+        if not self.db:
+            return 0
+        return sum(partition['count'] for partition in await self._archive_months())
+
+    # Statistics (count() aggregations, tallied server-side)
+    @staticmethod
+    async def _count(query):
+        return (await query.count().get())[0][0].value
+
+    @async_read_operation(default=0)
+    @_on_client_loop
+    async def get_user_count(self):
+        """Get total user count"""
+        if not self.db:
+            return 0
+        return await self._count(self.db.collection('users'))
+
+    @async_read_operation(default=0)
+    @_on_client_loop
+    async def get_appointment_count(self, include_archived=False):
+        """Get total appointment count (live appointments unless include_archived)"""
+        if not self.db:
+            return 0
+
+        live = self._count(self.db.collection('appointments'))
+        if not include_archived:
+            return await live
+        count, months = await asyncio.gather(live, self._archive_months())
+        return count + sum(partition['count'] for partition in months)
+
+    @async_read_operation(default=0)
+    @_on_client_loop
+    async def get_pending_appointments_count(self):
+        """Get pending appointments count"""
+        if not self.db:
+            return 0
+        return await self._count(self.db.collection('appointments').where('status', '==', 'pending'))
+
+# Global instance
+async_firebase_db = AsyncFirebaseDB()
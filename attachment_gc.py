@@ -0,0 +1,47 @@
+import os
+from datetime import datetime, timedelta, timezone
+from aws_storage import cloudinary_storage, parse_cloudinary_url
+from firebase_db import firebase_db
+
+# Uploads younger than this are never collected; direct uploads may not be booked yet
+GC_GRACE_HOURS = int(os.environ.get('ATTACHMENT_GC_GRACE_HOURS', 24))
+
+
+def _uploaded_at(created_at):
+    return datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+
+
+def collect_orphaned_attachments(prefix='appointments/', grace_hours=None, dry_run=False, storage=None, db=None):
+    """Delete Cloudinary uploads under `prefix` that no live or archived appointment references"""
+    storage = storage or cloudinary_storage
+    db = db or firebase_db
+    grace_hours = GC_GRACE_HOURS if grace_hours is None else grace_hours
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=grace_hours)
+
+    # List Cloudinary before reading Firestore, so an appointment booked in between is still seen
+    candidates = {}
+    listed = 0
+    for resource_type, public_id, created_at in storage.list_resources(prefix):
+        listed += 1
+        if not created_at or _uploaded_at(created_at) > cutoff:
+            continue
+        candidates.setdefault(resource_type, set()).add(public_id)
+
+    for attachment_url in db.stream_attachment_urls():
+        parsed = parse_cloudinary_url(attachment_url)
+        if parsed:
+            resource_type, _, public_id, _ = parsed
+            candidates.get(resource_type, set()).discard(public_id)
+
+    orphans = {resource_type: sorted(public_ids) for resource_type, public_ids in candidates.items() if public_ids}
+    stats = {
+        'listed': listed,
+        'orphaned': sum(len(public_ids) for public_ids in orphans.values()),
+        'deleted': 0,
+    }
+    if not dry_run:
+        for resource_type, public_ids in orphans.items():
+            stats['deleted'] += len(storage.delete_resources(public_ids, resource_type))
+
+    print(f"Attachment GC: {stats['listed']} listed, {stats['orphaned']} orphaned, {stats['deleted']} deleted")
+    return stats
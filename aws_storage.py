@@ -1,13 +1,74 @@
 import os
+import time
+import hmac
+import hashlib
 import uuid
+from functools import lru_cache
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 from cloudinary.exceptions import Error as CloudinaryError
 
+# Derived variants generated eagerly at upload time so admin pages never
+# trigger on-the-fly transformations for attachment previews
+ATTACHMENT_VARIANTS = {
+    'thumbnail': 'c_fill,w_160,h_160,q_auto',
+    'preview': 'c_limit,w_800,h_800,q_auto',
+}
+
+# Attachments Cloudinary can render as images (first page for PDFs)
+PREVIEWABLE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
+
+# Admin API pacing for bulk maintenance jobs: minimum seconds between calls, and how much
+# of the hourly Admin API quota to leave untouched for the app itself
+ADMIN_API_INTERVAL = float(os.environ.get('CLOUDINARY_ADMIN_API_INTERVAL', 0.5))
+ADMIN_API_RESERVE = int(os.environ.get('CLOUDINARY_ADMIN_API_RESERVE', 50))
+# delete_resources accepts at most 100 public IDs per call
+DELETE_BATCH_SIZE = 100
+
+# Browser-direct uploads must be attached to a booking within this many seconds
+DIRECT_UPLOAD_MAX_AGE = int(os.environ.get('CLOUDINARY_UPLOAD_MAX_AGE', 3600))
+# Formats a browser may upload directly; previewable ones are stored as images, the rest as raw files
+DIRECT_UPLOAD_FORMATS = PREVIEWABLE_EXTENSIONS | {'doc', 'docx'}
+
+
+@lru_cache(maxsize=2048)
+def parse_cloudinary_url(file_url):
+    """Parse a Cloudinary delivery URL into (resource_type, version, public_id, extension)"""
+    # Cloudinary URL format: https://res.cloudinary.com/cloud_name/image/upload/v123456/folder/filename.ext
+    if not file_url or 'res.cloudinary.com' not in file_url:
+        return None
+
+    url_parts = file_url.split('?', 1)[0].split('/')
+    try:
+        upload_index = url_parts.index('upload')
+    except ValueError:
+        return None
+
+    resource_type = url_parts[upload_index - 1]
+    version_index = -1
+    for i in range(upload_index + 1, len(url_parts)):
+        part = url_parts[i]
+        if part.startswith('v') and part[1:].isdigit():
+            version_index = i
+            break
+
+    if version_index == -1 or version_index + 1 >= len(url_parts):
+        return None
+
+    version = url_parts[version_index][1:]
+    public_id = '/'.join(url_parts[version_index + 1:])
+    extension = ''
+    if resource_type != 'raw' and '.' in public_id.rsplit('/', 1)[-1]:
+        # Raw assets keep their extension as part of the public ID
+        public_id, extension = public_id.rsplit('.', 1)
+    return resource_type, version, public_id, extension.lower()
+
 class CloudinaryStorage:
     def __init__(self):
         self.initialized = False
+        self.admin_rate_limit_remaining = None
+        self._next_admin_call = 0.0
         self.initialize_cloudinary()
     
     def initialize_cloudinary(self):
@@ -43,6 +104,20 @@ class CloudinaryStorage:
             print(f"Error initializing Cloudinary: {e}")
             self.initialized = False
     
+    def reset_connections(self):
+        """Re-create Cloudinary's HTTP connection pools (e.g. in a forked worker)"""
+        if not self.initialized:
+            return
+        
+        try:
+            import cloudinary.utils
+            import cloudinary.api_client.call_api
+            # The SDK keeps module-level urllib3 pools; don't share their sockets across processes
+            cloudinary.uploader._http = cloudinary.utils.get_http_connector(cloudinary.config(), cloudinary.CERT_KWARGS)
+            cloudinary.api_client.call_api._http = cloudinary.utils.get_http_connector(cloudinary.config(), cloudinary.CERT_KWARGS)
+        except Exception as e:
+            print(f"Error resetting Cloudinary connections: {e}")
+    
     def upload_file(self, file_obj, filename, folder='appointments'):
         """Upload file to Cloudinary"""
         if not self.initialized:
@@ -53,6 +128,12 @@ class CloudinaryStorage:
             file_extension = filename.split('.')[-1] if '.' in filename else ''
             public_id = f"{folder}/{uuid.uuid4()}_{filename.replace('.' + file_extension, '')}"
             
+            upload_options = {}
+            if file_extension.lower() in PREVIEWABLE_EXTENSIONS:
+                # Precompute thumbnail/preview derivatives during the upload
+                upload_options['eager'] = [f"{transformation}/jpg" for transformation in ATTACHMENT_VARIANTS.values()]
+                upload_options['eager_async'] = True
+            
             # Upload file
             result = cloudinary.uploader.upload(
                 file_obj,
@@ -61,7 +142,8 @@ class CloudinaryStorage:
                 folder=folder,
                 use_filename=True,
                 unique_filename=True,
-                overwrite=False
+                overwrite=False,
+                **upload_options
             )
             
             # Return the secure URL
@@ -74,34 +156,90 @@ class CloudinaryStorage:
             print(f"Error uploading file: {e}")
             raise e
     
+    def sign_direct_upload(self, user_id, filename, folder='appointments'):
+        """Signed upload parameters so the browser can send a file straight to Cloudinary"""
+        if not self.initialized:
+            raise Exception("Cloudinary not initialized")
+        
+        file_extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if file_extension not in DIRECT_UPLOAD_FORMATS:
+            raise ValueError("File type not allowed")
+        stem = filename.rsplit('.', 1)[0]
+        file_format = 'jpg' if file_extension == 'jpeg' else file_extension
+        resource_type = self._direct_upload_resource_type(file_format)
+        # The owner and format segments let verify_direct_upload reject another patient's upload
+        # and build the URL from the signed public ID alone; raw IDs keep their extension
+        public_id = f"{folder}/{self._owner_key(user_id)}/{file_format}/{uuid.uuid4()}_{stem}"
+        params = {
+            'public_id': f"{public_id}.{file_format}" if resource_type == 'raw' else public_id,
+            'allowed_formats': file_format,
+            'overwrite': 'false',
+            'timestamp': str(int(time.time())),
+        }
+        if resource_type == 'image':
+            params['eager'] = '|'.join(f"{transformation}/jpg" for transformation in ATTACHMENT_VARIANTS.values())
+            params['eager_async'] = 'true'
+        
+        config = cloudinary.config()
+        params['signature'] = cloudinary.utils.api_sign_request(params, config.api_secret)
+        params['api_key'] = config.api_key
+        return {
+            'upload_url': cloudinary.utils.cloudinary_api_url('upload', resource_type=resource_type),
+            'fields': params
+        }
+    
+    def verify_direct_upload(self, user_id, public_id, version, signature):
+        """Check a browser upload's response signature and return its delivery URL; raises ValueError"""
+        if not self.initialized:
+            raise ValueError("File uploads are not available")
+        if not all([public_id, version, signature]):
+            raise ValueError("Incomplete upload details")
+        if not public_id.startswith(f"appointments/{self._owner_key(user_id)}/"):
+            raise ValueError("Upload does not belong to this account")
+        if not cloudinary.utils.verify_api_response_signature(public_id, version, signature):
+            raise ValueError("Upload signature is invalid")
+        # Resource type and format come from the signed public ID, never from the client
+        parts = public_id.split('/')
+        file_format = parts[2] if len(parts) == 4 else None
+        if file_format not in DIRECT_UPLOAD_FORMATS:
+            raise ValueError("Upload details are invalid")
+        resource_type = self._direct_upload_resource_type(file_format)
+        if resource_type == 'raw' and not public_id.endswith(f".{file_format}"):
+            raise ValueError("Upload details are invalid")
+        # The version is the upload's Unix timestamp
+        if not str(version).isdigit() or time.time() - int(version) > DIRECT_UPLOAD_MAX_AGE:
+            raise ValueError("Upload has expired, please attach the file again")
+        
+        url, _ = cloudinary.utils.cloudinary_url(
+            public_id,
+            resource_type=resource_type,
+            version=version,
+            format=file_format if resource_type == 'image' else None,
+            secure=True
+        )
+        return url
+    
+    @staticmethod
+    def _direct_upload_resource_type(file_format):
+        return 'image' if file_format in PREVIEWABLE_EXTENSIONS else 'raw'
+    
+    @staticmethod
+    def _owner_key(user_id):
+        return hmac.new(cloudinary.config().api_secret.encode(), str(user_id).encode(), hashlib.sha256).hexdigest()[:16]
+    
     def delete_file(self, file_url):
         """Delete file from Cloudinary"""
         if not self.initialized:
             raise Exception("Cloudinary not initialized")
         
         try:
-            # Extract public ID from URL
-            # Cloudinary URL format: https://res.cloudinary.com/cloud_name/image/upload/v123456/folder/filename.ext
-            if 'res.cloudinary.com' in file_url:
-                # Split URL and extract public ID
-                url_parts = file_url.split('/')
-                if len(url_parts) >= 7:
-                    # Get everything after /upload/v123456/
-                    version_index = -1
-                    for i, part in enumerate(url_parts):
-                        if part.startswith('v') and part[1:].isdigit():
-                            version_index = i
-                            break
-                    
-                    if version_index != -1 and version_index + 1 < len(url_parts):
-                        public_id_parts = url_parts[version_index + 1:]
-                        public_id = '/'.join(public_id_parts)
-                        # Remove file extension
-                        public_id = public_id.rsplit('.', 1)[0]
-                        
-                        # Delete file
-                        result = cloudinary.uploader.destroy(public_id)
-                        return result.get('result') == 'ok'
+            parsed = parse_cloudinary_url(file_url)
+            if parsed:
+                resource_type, _, public_id, _ = parsed
+                
+                # Delete file
+                result = cloudinary.uploader.destroy(public_id, resource_type=resource_type)
+                return result.get('result') == 'ok'
             
             print(f"Could not extract public ID from URL: {file_url}")
             return False
@@ -113,44 +251,121 @@ class CloudinaryStorage:
             print(f"Error deleting file: {e}")
             return False
     
+    def admin_quota_low(self):
+        """True once the Admin API quota left this hour has reached the reserve"""
+        remaining = self.admin_rate_limit_remaining
+        return remaining is not None and remaining <= ADMIN_API_RESERVE
+    
+    def _admin_call(self, method, *args, **kwargs):
+        """Paced Admin API call that tracks the remaining hourly quota from the response headers"""
+        delay = self._next_admin_call - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            self._next_admin_call = time.monotonic() + ADMIN_API_INTERVAL
+        self.admin_rate_limit_remaining = getattr(result, 'rate_limit_remaining', None)
+        return result
+    
+    def list_resources(self, prefix='appointments/', resource_types=('image', 'raw')):
+        """Yield (resource_type, public_id, created_at) for every upload under `prefix`, 500 per call"""
+        if not self.initialized:
+            raise Exception("Cloudinary not initialized")
+        
+        for resource_type in resource_types:
+            next_cursor = None
+            while True:
+                options = {'type': 'upload', 'prefix': prefix, 'resource_type': resource_type, 'max_results': 500}
+                if next_cursor:
+                    options['next_cursor'] = next_cursor
+                result = self._admin_call(cloudinary.api.resources, **options)
+                for resource in result.get('resources', []):
+                    yield resource_type, resource['public_id'], resource.get('created_at')
+                
+                next_cursor = result.get('next_cursor')
+                if not next_cursor:
+                    break
+                if self.admin_quota_low():
+                    print(f"Cloudinary: Admin API quota low, stopped listing {resource_type} assets early")
+                    return
+    
+    def delete_resources(self, public_ids, resource_type='image'):
+        """Delete assets (and their derivatives) in bulk; returns the public IDs Cloudinary deleted"""
+        if not self.initialized:
+            raise Exception("Cloudinary not initialized")
+        
+        deleted = []
+        for start in range(0, len(public_ids), DELETE_BATCH_SIZE):
+            chunk = public_ids[start:start + DELETE_BATCH_SIZE]
+            try:
+                result = self._admin_call(cloudinary.api.delete_resources, chunk, resource_type=resource_type, type='upload')
+            except CloudinaryError as e:
+                print(f"Error bulk deleting {len(chunk)} {resource_type} assets: {e}")
+                continue
+            deleted.extend(public_id for public_id, status in result.get('deleted', {}).items() if status == 'deleted')
+            if self.admin_quota_low():
+                print("Cloudinary: Admin API quota low, stopped deleting early")
+                break
+        return deleted
+    
     def get_optimized_url(self, file_url, width=None, height=None, quality="auto"):
         """Get optimized URL for images"""
         if not self.initialized or 'res.cloudinary.com' not in file_url:
             return file_url
         
         try:
-            # Extract public ID from URL
-            url_parts = file_url.split('/')
-            version_index = -1
-            for i, part in enumerate(url_parts):
-                if part.startswith('v') and part[1:].isdigit():
-                    version_index = i
-                    break
+            # Build transformation parameters
+            transformations = []
+            if width:
+                transformations.append(f"w_{width}")
+            if height:
+                transformations.append(f"h_{height}")
+            if quality:
+                transformations.append(f"q_{quality}")
             
-            if version_index != -1 and version_index + 1 < len(url_parts):
-                public_id_parts = url_parts[version_index + 1:]
-                public_id = '/'.join(public_id_parts)
-                public_id = public_id.rsplit('.', 1)[0]  # Remove extension
-                
-                # Build transformation parameters
-                transformations = []
-                if width:
-                    transformations.append(f"w_{width}")
-                if height:
-                    transformations.append(f"h_{height}")
-                if quality:
-                    transformations.append(f"q_{quality}")
-                
-                # Generate optimized URL
-                if transformations:
-                    transformation_string = ','.join(transformations)
-                    return cloudinary.CloudinaryImage(public_id).build_url(transformation=transformation_string)
+            if not transformations:
+                return file_url
             
-            return file_url
+            return self._build_variant_url(file_url, ','.join(transformations), None) or file_url
             
         except Exception as e:
             print(f"Error generating optimized URL: {e}")
             return file_url
+    
+    def get_attachment_variant_url(self, file_url, variant='thumbnail'):
+        """Get the URL of an eagerly generated attachment derivative, or None if there is none"""
+        if not self.initialized or not file_url or variant not in ATTACHMENT_VARIANTS:
+            return None
+        
+        try:
+            return self._build_variant_url(file_url, ATTACHMENT_VARIANTS[variant], 'jpg')
+        except Exception as e:
+            print(f"Error generating attachment {variant} URL: {e}")
+            return None
+    
+    @staticmethod
+    @lru_cache(maxsize=2048)
+    def _build_variant_url(file_url, transformation, file_format):
+        parsed = parse_cloudinary_url(file_url)
+        if not parsed:
+            return None
+        
+        resource_type, version, public_id, extension = parsed
+        if resource_type != 'image':
+            return None
+        if file_format and extension not in PREVIEWABLE_EXTENSIONS:
+            return None
+        
+        url, _ = cloudinary.utils.cloudinary_url(
+            public_id,
+            resource_type=resource_type,
+            version=version,
+            raw_transformation=transformation,
+            format=file_format or extension or None,
+            secure=True
+        )
+        return url
 
 # Global instance
 cloudinary_storage = CloudinaryStorage()
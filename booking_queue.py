@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+from firebase_db import firebase_db
+from resilience import BackendUnavailableError, TRANSIENT_ERRORS
+
+# Write-behind booking: accept into a local journal, commit to Firestore in the background.
+# The journal must live on a persistent disk, so this stays off on Vercel.
+BOOKING_WRITE_BEHIND = os.environ.get('BOOKING_WRITE_BEHIND', '0') == '1' and not os.environ.get('VERCEL')
+BOOKING_JOURNAL_PATH = os.environ.get(
+    'BOOKING_JOURNAL_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'booking_journal.db')
+)
+BOOKING_FLUSH_INTERVAL = float(os.environ.get('BOOKING_FLUSH_INTERVAL', 1.0))
+# Up to four writes per booking (appointment, slot, timeline, report rollup) must fit one transaction
+BOOKING_FLUSH_BATCH = min(int(os.environ.get('BOOKING_FLUSH_BATCH', 50)), 120)
+BOOKING_MAX_ATTEMPTS = int(os.environ.get('BOOKING_MAX_ATTEMPTS', 20))
+# Settled journal rows are kept this long for the dashboard and reconciliation
+BOOKING_JOURNAL_RETENTION_DAYS = int(os.environ.get('BOOKING_JOURNAL_RETENTION_DAYS', 7))
+
+# A leased batch not settled within this many seconds (crashed worker) is retried by anyone
+LEASE_SECONDS = 60
+MAX_BACKOFF_SECONDS = 300
+
+# Firestore is down or struggling: back off the whole batch. Anything else is taken to be
+# a problem with a particular booking, which is then isolated by committing one at a time.
+OUTAGE_ERRORS = (BackendUnavailableError,) + TRANSIENT_ERRORS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bookings (
+    idempotency_key TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    leased_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    notified INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bookings_due ON bookings (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS bookings_user ON bookings (user_id, status);
+"""
+
+
+class BookingJournal:
+    """Durable SQLite (WAL) journal of accepted bookings, shared by every worker on the host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    with closing(sqlite3.connect(self.path, timeout=10)) as conn:
+                        conn.execute('PRAGMA journal_mode=WAL')
+                        conn.executescript(SCHEMA)
+                    self._ready = True
+
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # An acknowledged booking must survive a crash or power loss
+        conn.execute('PRAGMA synchronous=FULL')
+        return conn
+
+    def append(self, user_id, booking):
+        """Durably record a booking; returns its idempotency key"""
+        key = uuid.uuid4().hex
+        now = time.time()
+        payload = dict(booking, user_id=user_id, created_at=datetime.utcnow().isoformat())
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'INSERT INTO bookings (idempotency_key, user_id, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (key, user_id, json.dumps(payload), now, now)
+            )
+        return key
+
+    def lease_due(self, limit):
+        """Claim up to `limit` due bookings, oldest first, for one flush attempt"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                "SELECT idempotency_key, payload FROM bookings "
+                "WHERE status = 'pending' AND next_attempt_at <= ? AND leased_until <= ? "
+                "ORDER BY created_at LIMIT ?",
+                (now, now, limit)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE bookings SET leased_until = ? WHERE idempotency_key = ?',
+                [(now + LEASE_SECONDS, row['idempotency_key']) for row in rows]
+            )
+            conn.execute('COMMIT')
+        return [dict(json.loads(row['payload']), key=row['idempotency_key']) for row in rows]
+
+    def settle(self, results):
+        """Record final outcomes: {key: ('committed' | 'conflict', error)}"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.executemany(
+                'UPDATE bookings SET status = ?, last_error = ?, leased_until = 0, updated_at = ? WHERE idempotency_key = ?',
+                [(status, error, now, key) for key, (status, error) in results.items()]
+            )
+
+    def retry_later(self, keys, error):
+        """Release a failed batch with exponential backoff; give up after BOOKING_MAX_ATTEMPTS"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.executemany(
+                "UPDATE bookings SET attempts = attempts + 1, last_error = ?, leased_until = 0, "
+                "next_attempt_at = ? + MIN(?, 1 << MIN(attempts, 16)), "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END, updated_at = ? "
+                "WHERE idempotency_key = ?",
+                [(str(error)[:500], now, MAX_BACKOFF_SECONDS, BOOKING_MAX_ATTEMPTS, now, key) for key in keys]
+            )
+
+    def requeue_failed(self):
+        """Give bookings that exhausted their attempts another round; returns how many"""
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "UPDATE bookings SET status = 'pending', attempts = 0, next_attempt_at = 0, updated_at = ? WHERE status = 'failed'",
+                (time.time(),)
+            ).rowcount
+
+    def for_user(self, user_id):
+        """A patient's bookings still awaiting Firestore, plus rejected ones they haven't been told about"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT idempotency_key, payload, status, last_error FROM bookings "
+                "WHERE user_id = ? AND (status = 'pending' OR (status IN ('conflict', 'failed') AND notified = 0)) "
+                "ORDER BY created_at DESC",
+                (user_id,)
+            ).fetchall()
+        return [dict(json.loads(row['payload']), key=row['idempotency_key'], journal_status=row['status'],
+                     error=row['last_error']) for row in rows]
+
+    def mark_notified(self, keys):
+        with closing(self._connect()) as conn:
+            conn.executemany('UPDATE bookings SET notified = 1 WHERE idempotency_key = ?', [(key,) for key in keys])
+
+    def prune(self):
+        cutoff = time.time() - BOOKING_JOURNAL_RETENTION_DAYS * 86400
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "DELETE FROM bookings WHERE status IN ('committed', 'conflict') AND updated_at < ?", (cutoff,)
+            ).rowcount
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            counts = {row['status']: row['count'] for row in conn.execute(
+                'SELECT status, COUNT(*) AS count FROM bookings GROUP BY status'
+            )}
+            oldest = conn.execute("SELECT MIN(created_at) FROM bookings WHERE status = 'pending'").fetchone()[0]
+        return {
+            'by_status': counts,
+            'oldest_pending_seconds': round(time.time() - oldest, 1) if oldest else None,
+        }
+
+
+class BookingQueue:
+    """Write-behind booking: journal locally and acknowledge, flush to Firestore in batches"""
+
+    def __init__(self, db=None, journal=None, enabled=None, interval=None, batch_size=None):
+        self.firebase_db = db or firebase_db
+        self.journal = journal or BookingJournal(BOOKING_JOURNAL_PATH)
+        self.enabled = BOOKING_WRITE_BEHIND if enabled is None else enabled
+        self.interval = BOOKING_FLUSH_INTERVAL if interval is None else interval
+        self.batch_size = batch_size or BOOKING_FLUSH_BATCH
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start this process's flusher thread if it isn't running"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='booking-flusher', daemon=True)
+                self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def submit(self, user_id, service, date, time, notes=None, attachment_url=None, attachment_filename=None):
+        """Journal a booking and return its idempotency key without touching Firestore"""
+        key = self.journal.append(user_id, {
+            'service': service,
+            'date': date.isoformat(),
+            'time': time.strftime('%H:%M:%S'),
+            'notes': notes,
+            'attachment_url': attachment_url,
+            'attachment_filename': attachment_filename,
+        })
+        self.start()
+        self._wake.set()
+        return key
+
+    def flush_once(self):
+        """Commit one batch of due bookings; returns how many were leased"""
+        bookings = self.journal.lease_due(self.batch_size)
+        if not bookings:
+            return 0
+
+        keys = [booking['key'] for booking in bookings]
+        try:
+            results = self.firebase_db.commit_queued_bookings(bookings)
+        except OUTAGE_ERRORS as e:
+            print(f"Booking queue: commit of {len(keys)} bookings failed, will retry: {e}")
+            self.journal.retry_later(keys, e)
+            return len(bookings)
+        except Exception as e:
+            if len(bookings) == 1:
+                print(f"Booking queue: commit of booking {keys[0]} failed, will retry: {e}")
+                self.journal.retry_later(keys, e)
+                return 1
+            # Something in the batch itself is bad; commit one at a time so only the offending bookings wait
+            print(f"Booking queue: commit of {len(keys)} bookings failed, committing them one by one: {e}")
+            results = self._commit_individually(bookings)
+
+        if results:
+            self.journal.settle(results)
+        conflicts = sum(1 for status, _ in results.values() if status == 'conflict')
+        print(f"Booking queue: committed {len(results) - conflicts} bookings, {conflicts} slot conflicts")
+        return len(bookings)
+
+    def _commit_individually(self, bookings):
+        results = {}
+        for i, booking in enumerate(bookings):
+            try:
+                results.update(self.firebase_db.commit_queued_bookings([booking]))
+            except OUTAGE_ERRORS as e:
+                # Firestore itself is down; everything not yet committed waits for the backoff
+                remaining = [pending['key'] for pending in bookings[i:]]
+                print(f"Booking queue: commit of {len(remaining)} bookings failed, will retry: {e}")
+                self.journal.retry_later(remaining, e)
+                break
+            except Exception as e:
+                print(f"Booking queue: commit of booking {booking['key']} failed, will retry: {e}")
+                self.journal.retry_later([booking['key']], e)
+        return results
+
+    def drain(self):
+        """Flush until nothing is due; returns how many bookings were processed"""
+        total = 0
+        while True:
+            flushed = self.flush_once()
+            total += flushed
+            if flushed < self.batch_size:
+                return total
+
+    def for_user(self, user_id):
+        return self.journal.for_user(user_id) if self.enabled else []
+
+    def stats(self):
+        stats = self.journal.stats()
+        stats['flusher_alive'] = bool(self._thread and self._thread.is_alive())
+        return stats
+
+    def _run(self):
+        last_prune = 0
+        while not self._stop.is_set():
+            try:
+                # A full batch suggests a backlog, so go straight to the next one
+                if self.flush_once() >= self.batch_size:
+                    continue
+                if time.time() - last_prune > 3600:
+                    self.journal.prune()
+                    last_prune = time.time()
+            except Exception as e:
+                print(f"Booking queue: flusher error: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+# Global instance
+booking_queue = BookingQueue()
@@ -0,0 +1,223 @@
+import os
+import gzip
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/html',
+    'text/plain',
+    'text/css',
+    'text/csv',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'application/x-ndjson',
+    'application/xml',
+    'image/svg+xml',
+)
+
+
+class CompressionMiddleware:
+    """WSGI middleware that compresses HTML/JSON responses with Brotli or gzip"""
+
+    def __init__(self, app, min_size=None, cache_size=None, gzip_level=6, brotli_quality=5):
+        self.app = app
+        self.min_size = min_size if min_size is not None else int(os.environ.get('COMPRESSION_MIN_SIZE', 500))
+        self.cache_size = cache_size if cache_size is not None else int(os.environ.get('COMPRESSION_CACHE_SIZE', 128))
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if not encoding or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            # Defer the real start_response until we know whether to compress
+            return captured.setdefault('chunks', []).append
+
+        app_iter = self.app(environ, capture_start_response)
+        status = captured['status']
+        headers = captured['headers']
+
+        if not self.should_compress(status, headers):
+            start_response(status, headers, captured['exc_info'])
+            return self._passthrough(captured.get('chunks', []), app_iter)
+
+        content_length = self._get_header(headers, 'Content-Length')
+        if content_length is not None:
+            # Buffered response: compress the whole body in one go
+            try:
+                body = b''.join(captured.get('chunks', [])) + b''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+
+            if len(body) < self.min_size:
+                start_response(status, headers, captured['exc_info'])
+                return [body]
+
+            compressed = self.compress_cached(body, encoding)
+            if len(compressed) >= len(body):
+                start_response(status, headers, captured['exc_info'])
+                return [body]
+
+            headers = self._rewrite_headers(headers, encoding, len(compressed))
+            start_response(status, headers, captured['exc_info'])
+            return [compressed]
+
+        # Streamed response: compress chunk by chunk and flush as we go
+        headers = self._rewrite_headers(headers, encoding, None)
+        start_response(status, headers, captured['exc_info'])
+        return self._stream(captured.get('chunks', []), app_iter, encoding)
+
+    def negotiate(self, accept_encoding):
+        """Pick the best supported encoding from an Accept-Encoding header"""
+        accepted = {}
+        for item in accept_encoding.split(','):
+            parts = item.strip().split(';')
+            name = parts[0].strip().lower()
+            if not name:
+                continue
+            quality = 1.0
+            for param in parts[1:]:
+                param = param.strip()
+                if param.startswith('q='):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0.0
+            accepted[name] = quality
+
+        candidates = ['br', 'gzip'] if brotli else ['gzip']
+        best = None
+        best_quality = 0.0
+        for name in candidates:
+            quality = accepted.get(name, accepted.get('*', 0.0))
+            if quality > best_quality:
+                best = name
+                best_quality = quality
+        return best
+
+    def should_compress(self, status, headers):
+        """Check whether a response is worth compressing"""
+        code = status.split(' ', 1)[0]
+        if code in ('204', '206', '304') or code.startswith('1'):
+            return False
+        if self._get_header(headers, 'Content-Encoding'):
+            return False
+        if 'no-transform' in (self._get_header(headers, 'Cache-Control') or ''):
+            return False
+
+        content_type = (self._get_header(headers, 'Content-Type') or '').split(';')[0].strip().lower()
+        if content_type not in COMPRESSIBLE_TYPES:
+            return False
+
+        content_length = self._get_header(headers, 'Content-Length')
+        if content_length is not None:
+            try:
+                if int(content_length) < self.min_size:
+                    return False
+            except ValueError:
+                return False
+        return True
+
+    def compress(self, body, encoding):
+        """Compress a complete body"""
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    def compress_cached(self, body, encoding):
+        """Compress a body, reusing the compressed variant of identical pages"""
+        if not self.cache_size:
+            return self.compress(body, encoding)
+
+        key = (hashlib.sha1(body).digest(), encoding)
+        with self._cache_lock:
+            compressed = self._cache.get(key)
+            if compressed is not None:
+                self._cache.move_to_end(key)
+                return compressed
+
+        compressed = self.compress(body, encoding)
+        with self._cache_lock:
+            self._cache[key] = compressed
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return compressed
+
+    def _stream(self, early_chunks, app_iter, encoding):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            process = compressor.process
+            flush = compressor.flush
+            finish = compressor.finish
+        else:
+            # wbits=31 produces a gzip container
+            compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+            process = compressor.compress
+            flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            finish = compressor.flush
+
+        for chunk in self._passthrough(early_chunks, app_iter):
+            if not chunk:
+                continue
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        tail = finish()
+        if tail:
+            yield tail
+
+    @staticmethod
+    def _passthrough(early_chunks, app_iter):
+        try:
+            for chunk in early_chunks:
+                yield chunk
+            for chunk in app_iter:
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    @staticmethod
+    def _get_header(headers, name):
+        name = name.lower()
+        for key, value in headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    @staticmethod
+    def _rewrite_headers(headers, encoding, content_length):
+        rewritten = [(key, value) for key, value in headers
+                     if key.lower() not in ('content-length', 'content-encoding')]
+        rewritten.append(('Content-Encoding', encoding))
+        # A strong ETag no longer matches the transformed bytes
+        rewritten = [(key, f"W/{value}" if key.lower() == 'etag' and not value.startswith('W/') else value)
+                     for key, value in rewritten]
+        if content_length is not None:
+            rewritten.append(('Content-Length', str(content_length)))
+
+        vary = [value for key, value in rewritten if key.lower() == 'vary']
+        if not vary:
+            rewritten.append(('Vary', 'Accept-Encoding'))
+        elif 'accept-encoding' not in vary[0].lower():
+            rewritten = [(key, value) for key, value in rewritten if key.lower() != 'vary']
+            rewritten.append(('Vary', f"{vary[0]}, Accept-Encoding"))
+        return rewritten
@@ -0,0 +1,133 @@
+import io
+import csv
+import json
+import itertools
+from datetime import datetime, date
+from collections import OrderedDict
+
+APPOINTMENT_EXPORT_FIELDS = [
+    'id', 'date', 'time', 'service', 'status',
+    'patient_card_number', 'first_name', 'last_name', 'email', 'phone',
+    'notes', 'attachment_url', 'attachment_filename', 'created_at', 'updated_at',
+]
+
+DIAGNOSIS_EXPORT_FIELDS = [
+    'id', 'user_id', 'patient_card_number', 'first_name', 'last_name', 'email',
+    'diagnosis', 'treatment', 'notes', 'status', 'created_by_admin', 'created_at', 'updated_at',
+]
+
+# Patient fields joined onto each exported row
+PATIENT_FIELDS = ['patient_card_number', 'first_name', 'last_name', 'email', 'phone']
+
+# Flush the output buffer once it reaches this many characters
+CHUNK_SIZE = 64 * 1024
+
+# Rows buffered per batched patient read while joining
+JOIN_PAGE_SIZE = 300
+
+# Spreadsheet apps run a cell starting with one of these as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class PatientLookup:
+    """Bounded cache of patient details, filled a page of rows at a time with one batched read"""
+
+    def __init__(self, db, max_entries=5000):
+        self.db = db
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+
+    def get(self, user_id):
+        return self.get_many([user_id])[user_id]
+
+    def get_many(self, user_ids):
+        """Patient details for each of `user_ids`, reading the uncached ones in one projected batch"""
+        patients = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            if not user_id:
+                patients[user_id] = {}
+            elif user_id in self._cache:
+                self._cache.move_to_end(user_id)
+                patients[user_id] = self._cache[user_id]
+            else:
+                missing.append(user_id)
+
+        summaries = self.db.get_user_summaries(missing) if missing else {}
+        for user_id in missing:
+            summary = summaries.get(user_id)
+            patients[user_id] = {field: summary.get(field) for field in PATIENT_FIELDS} if summary else {}
+            self._cache[user_id] = patients[user_id]
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return patients
+
+
+def serialize_value(value):
+    """Convert Firestore values into plain export values"""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def csv_cell(value):
+    """serialize_value for CSV: patient-entered text is quoted so it can't run as a formula"""
+    value = serialize_value(value)
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def join_patients(rows, patients, page_size=JOIN_PAGE_SIZE):
+    """Attach patient details to each row, reading patients once per page of rows"""
+    rows = iter(rows)
+    while True:
+        page = list(itertools.islice(rows, page_size))
+        if not page:
+            return
+        page_patients = patients.get_many([row.get('user_id') for row in page])
+        for row in page:
+            patient = page_patients[row.get('user_id')]
+            for field in PATIENT_FIELDS:
+                row.setdefault(field, patient.get(field))
+            yield row
+
+
+def generate_csv(rows, fields):
+    """Yield CSV text in ~64KB chunks"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+
+    for row in rows:
+        writer.writerow({field: csv_cell(row.get(field)) for field in fields})
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def generate_jsonl(rows, fields):
+    """Yield JSON Lines text in ~64KB chunks"""
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps({field: serialize_value(row.get(field)) for field in fields}, default=str)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= CHUNK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+            size = 0
+
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (generate_csv, 'text/csv'),
+    'jsonl': (generate_jsonl, 'application/x-ndjson'),
+}
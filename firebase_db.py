@@ -1,13 +1,93 @@
 import os
 import json
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 import firebase_admin
 from firebase_admin import credentials, firestore
 from datetime import datetime
 import bcrypt
 from werkzeug.security import generate_password_hash, check_password_hash
+from slots import SlotUnavailableError, InvalidStatusTransitionError, check_status_transition, slot_index, slot_document_id, is_clinic_day
+from resilience import firestore_guard, read_operation, write_operation, FIRESTORE_BATCH_TIMEOUT, FIRESTORE_READ_RETRIES
+
+# Most recent appointments/diagnoses kept in each patient_timelines/{user_id} document
+TIMELINE_LIMIT = int(os.environ.get('PATIENT_TIMELINE_LIMIT', 50))
+
+# Appointments dated more than this many days ago are moved to monthly archive partitions
+ARCHIVE_AFTER_DAYS = int(os.environ.get('APPOINTMENT_ARCHIVE_DAYS', 180))
+
+# Appointment notes are shown truncated in list views; this prefix is stored alongside them
+NOTES_PREVIEW_LENGTH = 120
+
+
+def make_row_type(name, fields, extra=()):
+    """Build a lightweight __slots__ row class for a list projection; `extra` slots are filled in later"""
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        for field in fields:
+            setattr(self, field, data.get(field))
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __repr__(self):
+        return f"<{name} {self.id}>"
+
+    return type(name, (), {
+        '__slots__': ('id',) + tuple(fields) + tuple(extra),
+        '__init__': __init__,
+        'get': get,
+        '__getitem__': __getitem__,
+        '__setitem__': __setitem__,
+        '__repr__': __repr__,
+    })
+
+
+def notes_preview(notes):
+    if not notes:
+        return None
+    return notes if len(notes) <= NOTES_PREVIEW_LENGTH else notes[:NOTES_PREVIEW_LENGTH - 1].rstrip() + '\u2026'
+
+
+def _event_time(entry):
+    # Freshly written entries hold naive UTC datetimes; stored ones come back timezone-aware
+    created_at = entry['created_at']
+    return created_at.replace(tzinfo=timezone.utc) if created_at.tzinfo is None else created_at
+
 
 class FirebaseDB:
+    # Per-view projections (Firestore select()). List methods fetch only these
+    # fields; detail views (get_user_by_id, get_appointment_by_id) read full documents.
+    USER_LIST_FIELDS = ('email', 'first_name', 'last_name', 'phone', 'patient_card_number', 'is_admin', 'created_at')
+    USER_SUMMARY_FIELDS = ('email', 'first_name', 'last_name', 'phone', 'patient_card_number')
+    # Loaded for the session principal on every request, and for profile pages; never the password hash
+    PRINCIPAL_FIELDS = ('first_name', 'last_name', 'is_admin')
+    PROFILE_FIELDS = ('email', 'first_name', 'last_name', 'phone', 'patient_card_number', 'date_of_birth', 'address',
+                      'emergency_contact', 'emergency_phone', 'is_admin', 'created_at')
+    APPOINTMENT_LIST_FIELDS = ('user_id', 'service', 'date', 'time', 'status', 'notes_preview',
+                               'attachment_url', 'attachment_filename', 'created_at')
+    # Read before a status change so its report rollup can move the appointment between statuses
+    ROLLUP_SOURCE_FIELDS = ('user_id', 'service', 'date', 'status')
+    
+    UserRow = make_row_type('UserRow', USER_LIST_FIELDS)
+    UserSummary = make_row_type('UserSummary', USER_SUMMARY_FIELDS)
+    AppointmentRow = make_row_type('AppointmentRow', APPOINTMENT_LIST_FIELDS, extra=('user',))
+    
+    # Event fields copied into patient timelines, per event kind
+    TIMELINE_FIELDS = {
+        'appointments': ('service', 'date', 'time', 'status', 'notes', 'attachment_url', 'attachment_filename', 'created_at', 'updated_at'),
+        'diagnoses': ('diagnosis', 'treatment', 'notes', 'status', 'created_by_admin', 'created_at', 'updated_at'),
+    }
+    
     def __init__(self):
         self.db = None
         self.initialize_firebase()
@@ -44,121 +124,196 @@ class FirebaseDB:
             print(f"Error initializing Firebase Firestore: {e}")
             self.db = None
     
+    def reset_client(self):
+        """Replace the Firestore client with a fresh one (e.g. in a forked worker)"""
+        if not firebase_admin._apps:
+            return
+        
+        try:
+            # firestore.client() is cached on the app, so build a new client
+            # from the app's credentials instead of reusing the parent's gRPC channel
+            app = firebase_admin.get_app()
+            self.db = firestore.Client(credentials=app.credential.get_credential(), project=app.project_id)
+            print(f"Firebase Firestore client re-created in process {os.getpid()}")
+        except Exception as e:
+            print(f"Error re-creating Firestore client: {e}")
+            self.db = None
+    
+    def close(self):
+        """Close the Firestore client's channel"""
+        if self.db is not None:
+            try:
+                self.db.close()
+            except Exception as e:
+                print(f"Error closing Firestore client: {e}")
+    
     # User Management
+    @write_operation()
     def create_user(self, email, password, first_name, last_name, phone, patient_card_number=None, date_of_birth=None, address=None, emergency_contact=None, emergency_phone=None, is_admin=False):
         """Create a new user"""
         if not self.db:
             raise Exception("Firestore not initialized")
         
-        try:
-            # Hash password
-            password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-            
-            # Generate patient card number if not provided (not needed for admin)
-            if not patient_card_number and not is_admin:
-                import random
-                patient_card_number = f"FF{random.randint(100000, 999999)}"
-            
-            user_data = {
-                'email': email,
-                'password_hash': password_hash.decode('utf-8'),
-                'first_name': first_name,
-                'last_name': last_name,
-                'phone': phone,
-                'patient_card_number': patient_card_number,
-                'date_of_birth': date_of_birth,
-                'address': address,
-                'emergency_contact': emergency_contact,
-                'emergency_phone': emergency_phone,
-                'is_admin': is_admin,
-                'created_at': datetime.utcnow()
-            }
-            
-            # Check if user already exists by email or patient card number
-            existing_user = self.db.collection('users').where('email', '==', email).limit(1).get()
-            if len(existing_user) > 0:
-                return None  # User already exists
-            
-            if patient_card_number:
-                existing_patient = self.db.collection('users').where('patient_card_number', '==', patient_card_number).limit(1).get()
-                if len(existing_patient) > 0:
-                    return None  # Patient card number already exists
-            
-            # Create user document
-            doc_ref = self.db.collection('users').add(user_data)
-            user_data['id'] = doc_ref[1].id
-            return user_data
-            
-        except Exception as e:
-            print(f"Error creating user: {e}")
-            return None
+        # Hash password
+        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        
+        # Generate patient card number if not provided (not needed for admin)
+        if not patient_card_number and not is_admin:
+            import random
+            patient_card_number = f"FF{random.randint(100000, 999999)}"
+        
+        user_data = {
+            'email': email,
+            'password_hash': password_hash.decode('utf-8'),
+            'first_name': first_name,
+            'last_name': last_name,
+            'phone': phone,
+            'patient_card_number': patient_card_number,
+            'date_of_birth': date_of_birth,
+            'address': address,
+            'emergency_contact': emergency_contact,
+            'emergency_phone': emergency_phone,
+            'is_admin': is_admin,
+            'created_at': datetime.utcnow()
+        }
+        # Every user write stamps updated_at so other workers' search indexes pick it up
+        user_data['updated_at'] = user_data['created_at']
+        
+        # Check if user already exists by email or patient card number
+        existing_user = self.db.collection('users').where('email', '==', email).limit(1).get()
+        if len(existing_user) > 0:
+            return None  # User already exists
+        
+        if patient_card_number:
+            existing_patient = self.db.collection('users').where('patient_card_number', '==', patient_card_number).limit(1).get()
+            if len(existing_patient) > 0:
+                return None  # Patient card number already exists
+        
+        # Create user document, counting new patients in the same write
+        user_ref = self.db.collection('users').document()
+        batch = self.db.batch()
+        batch.create(user_ref, user_data)
+        if not is_admin:
+            self._count_new_patient(batch, user_data['created_at'])
+        batch.commit()
+        user_data['id'] = user_ref.id
+        return user_data
     
+    # Full user documents carry the password hash, so they are never kept for stale serving
+    @read_operation(stale=False)
     def get_user_by_email(self, email):
         """Get user by email"""
         if not self.db:
             return None
         
-        try:
-            users = self.db.collection('users').where('email', '==', email).limit(1).get()
-            if users:
-                user_doc = users[0]
-                user_data = user_doc.to_dict()
-                user_data['id'] = user_doc.id
-                return user_data
-            return None
-        except Exception as e:
-            print(f"Error getting user by email: {e}")
-            return None
+        users = self.db.collection('users').where('email', '==', email).limit(1).get()
+        if users:
+            user_doc = users[0]
+            user_data = user_doc.to_dict()
+            user_data['id'] = user_doc.id
+            return user_data
+        return None
     
+    @read_operation(stale=False)
     def get_user_by_patient_number(self, patient_number):
         """Get user by patient card number"""
         if not self.db:
             return None
         
-        try:
-            users = self.db.collection('users').where('patient_card_number', '==', patient_number).limit(1).get()
-            if users:
-                user_doc = users[0]
-                user_data = user_doc.to_dict()
-                user_data['id'] = user_doc.id
-                return user_data
-            return None
-        except Exception as e:
-            print(f"Error getting user by patient number: {e}")
-            return None
+        users = self.db.collection('users').where('patient_card_number', '==', patient_number).limit(1).get()
+        if users:
+            user_doc = users[0]
+            user_data = user_doc.to_dict()
+            user_data['id'] = user_doc.id
+            return user_data
+        return None
     
+    @read_operation(stale=False)
     def get_user_by_id(self, user_id):
         """Get user by document ID"""
         if not self.db:
             return None
         
-        try:
-            user_doc = self.db.collection('users').document(user_id).get()
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                user_data['id'] = user_doc.id
-                return user_data
-            return None
-        except Exception as e:
-            print(f"Error getting user by ID: {e}")
+        user_doc = self.db.collection('users').document(user_id).get()
+        if user_doc.exists:
+            user_data = user_doc.to_dict()
+            user_data['id'] = user_doc.id
+            return user_data
+        return None
+    
+    @read_operation()
+    def get_user_principal(self, user_id):
+        """The few fields a logged-in request needs, from a projected read"""
+        return self._get_user_fields(user_id, self.PRINCIPAL_FIELDS)
+    
+    @read_operation()
+    def get_user_profile(self, user_id):
+        """A user's profile fields, without the password hash"""
+        return self._get_user_fields(user_id, self.PROFILE_FIELDS)
+    
+    def _get_user_fields(self, user_id, fields):
+        if not self.db:
             return None
+        
+        user_doc = self.db.collection('users').document(user_id).get(field_paths=fields)
+        if user_doc.exists:
+            user_data = user_doc.to_dict()
+            user_data['id'] = user_doc.id
+            return user_data
+        return None
     
-    def get_all_users(self):
-        """Get all users"""
+    @read_operation(default=list)
+    def get_all_users(self, limit=None):
+        """Get all users as lightweight rows (no password hashes), newest first"""
         if not self.db:
             return []
         
-        try:
-            users = []
-            docs = self.db.collection('users').order_by('created_at', direction=firestore.Query.DESCENDING).get()
-            for doc in docs:
-                user_data = doc.to_dict()
-                user_data['id'] = doc.id
-                users.append(user_data)
-            return users
-        except Exception as e:
-            print(f"Error getting all users: {e}")
-            return []
+        query = self.db.collection('users').select(self.USER_LIST_FIELDS).order_by('created_at', direction=firestore.Query.DESCENDING)
+        if limit:
+            query = query.limit(limit)
+        return [self.UserRow(doc.id, doc.to_dict()) for doc in query.stream()]
+    
+    def stream_users(self, page_size=500, first_page_size=50):
+        """Yield user rows newest first, holding one page in memory; read errors propagate"""
+        if not self.db:
+            return
+        
+        query = self.db.collection('users').select(self.USER_LIST_FIELDS).order_by('created_at', direction=firestore.Query.DESCENDING)
+        for doc in self._stream_paginated(query, page_size, first_page_size):
+            yield self.UserRow(doc.id, doc.to_dict())
+    
+    def stream_users_updated_since(self, since, page_size=500):
+        """Yield rows for users created or edited after `since`; read errors propagate"""
+        if not self.db:
+            return
+        
+        query = (self.db.collection('users').select(self.USER_LIST_FIELDS)
+                 .where('updated_at', '>', since).order_by('updated_at'))
+        for doc in self._stream_paginated(query, page_size):
+            yield self.UserRow(doc.id, doc.to_dict())
+    
+    @read_operation(default=dict, stale=False)
+    def get_user_summaries(self, user_ids):
+        """Fetch name/email summaries for many users in one batched read"""
+        if not self.db:
+            return {}
+        
+        user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id]
+        if not user_ids:
+            return {}
+        
+        refs = [self.db.collection('users').document(user_id) for user_id in user_ids]
+        return {
+            snapshot.id: self.UserSummary(snapshot.id, snapshot.to_dict())
+            for snapshot in self.db.get_all(refs, field_paths=self.USER_SUMMARY_FIELDS)
+            if snapshot.exists
+        }
+    
+    def _attach_users(self, appointments):
+        users = self.get_user_summaries(appointment['user_id'] for appointment in appointments)
+        for appointment in appointments:
+            appointment['user'] = users.get(appointment['user_id'])
+        return appointments
     
     def verify_password(self, user_data, password):
         """Verify user password"""
@@ -171,300 +326,1099 @@ class FirebaseDB:
             print(f"Password verification error: {e}")
             return False
     
+    @write_operation(default=False)
     def create_admin_user(self):
         """Create default admin user if none exists"""
-        try:
-            # Delete any existing admin users first
-            admin_users = self.db.collection('users').where('is_admin', '==', True).get()
-            for admin_doc in admin_users:
-                print(f"Deleting existing admin: {admin_doc.id}")
-                admin_doc.reference.delete()
-            
-            # Also delete by email if exists
-            email_users = self.db.collection('users').where('email', '==', 'admin@fixandfit.com').get()
-            for email_doc in email_users:
-                print(f"Deleting existing admin by email: {email_doc.id}")
-                email_doc.reference.delete()
-            
-            # Create fresh admin user
-            admin_data = self.create_user(
-                email='admin@fixandfit.com',
-                password='admin123',
-                first_name='Admin',
-                last_name='User',
-                phone='+1234567890',
-                is_admin=True
-            )
-            print(f"Admin creation result: {admin_data}")
-            return admin_data
-        except Exception as e:
-            print(f"Error in create_admin_user: {e}")
-            return False
+        # Delete any existing admin users first
+        admin_users = self.db.collection('users').where('is_admin', '==', True).get()
+        for admin_doc in admin_users:
+            print(f"Deleting existing admin: {admin_doc.id}")
+            admin_doc.reference.delete()
+        
+        # Also delete by email if exists
+        email_users = self.db.collection('users').where('email', '==', 'admin@fixandfit.com').limit(1).get()
+        for email_doc in email_users:
+            print(f"Deleting existing admin by email: {email_doc.id}")
+            email_doc.reference.delete()
+        
+        # Create fresh admin user
+        admin_data = self.create_user(
+            email='admin@fixandfit.com',
+            password='admin123',
+            first_name='Admin',
+            last_name='User',
+            phone='+1234567890',
+            is_admin=True
+        )
+        print(f"Admin creation result: {admin_data}")
+        return admin_data
     
+    @write_operation(default=False)
     def update_user_details(self, user_id, first_name, last_name, email, phone, date_of_birth=None, address=None, emergency_contact=None, emergency_phone=None):
         """Update user details in Firestore"""
         if not self.db:
             return False
         
-        try:
-            update_data = {
-                'first_name': first_name,
-                'last_name': last_name,
-                'email': email,
-                'phone': phone,
-                'updated_at': datetime.utcnow()
-            }
-            
-            # Add optional fields if provided
-            if date_of_birth:
-                update_data['date_of_birth'] = date_of_birth
-            if address:
-                update_data['address'] = address
-            if emergency_contact:
-                update_data['emergency_contact'] = emergency_contact
-            if emergency_phone:
-                update_data['emergency_phone'] = emergency_phone
-            
-            self.db.collection('users').document(user_id).update(update_data)
-            print(f"Updated user details for user_id: {user_id}")
-            return True
-            
-        except Exception as e:
-            print(f"Error updating user details: {e}")
-            return False
+        update_data = {
+            'first_name': first_name,
+            'last_name': last_name,
+            'email': email,
+            'phone': phone,
+            'updated_at': datetime.utcnow()
+        }
+        
+        # Add optional fields if provided
+        if date_of_birth:
+            update_data['date_of_birth'] = date_of_birth
+        if address:
+            update_data['address'] = address
+        if emergency_contact:
+            update_data['emergency_contact'] = emergency_contact
+        if emergency_phone:
+            update_data['emergency_phone'] = emergency_phone
+        
+        self.db.collection('users').document(user_id).update(update_data)
+        print(f"Updated user details for user_id: {user_id}")
+        return True
 
     # Diagnosis and Patient History Management
+    @write_operation()
     def create_diagnosis(self, user_id, diagnosis, treatment, notes=None, created_by_admin=None):
         """Create a new diagnosis for a patient"""
         if not self.db:
             raise Exception("Firestore not initialized")
         
-        try:
-            diagnosis_data = {
-                'user_id': user_id,
-                'diagnosis': diagnosis,
-                'treatment': treatment,
-                'notes': notes,
-                'created_by_admin': created_by_admin,
-                'created_at': datetime.utcnow(),
-                'status': 'active'
-            }
-            
-            doc_ref = self.db.collection('diagnoses').add(diagnosis_data)
-            diagnosis_data['id'] = doc_ref[1].id
-            print(f"Created diagnosis: {diagnosis_data}")
-            return diagnosis_data
-            
-        except Exception as e:
-            print(f"Error creating diagnosis: {e}")
-            return None
+        diagnosis_data = {
+            'user_id': user_id,
+            'diagnosis': diagnosis,
+            'treatment': treatment,
+            'notes': notes,
+            'created_by_admin': created_by_admin,
+            'created_at': datetime.utcnow(),
+            'status': 'active'
+        }
+        
+        diagnosis_ref = self.db.collection('diagnoses').document()
+        timeline_ref = self._timeline_ref(user_id)
+        
+        @firestore.transactional
+        def create(transaction):
+            timeline_snapshot = timeline_ref.get(transaction=transaction)
+            transaction.create(diagnosis_ref, diagnosis_data)
+            self._add_timeline_event(transaction, timeline_snapshot, 'diagnoses', diagnosis_ref.id, diagnosis_data)
+        
+        create(self.db.transaction())
+        diagnosis_data['id'] = diagnosis_ref.id
+        print(f"Created diagnosis: {diagnosis_data}")
+        return diagnosis_data
     
+    @read_operation(default=list)
     def get_patient_history(self, user_id):
         """Get all diagnoses/history for a patient"""
         if not self.db:
             return []
         
-        try:
-            history = []
-            docs = self.db.collection('diagnoses').where('user_id', '==', user_id).get()
-            for doc in docs:
-                diagnosis_data = doc.to_dict()
-                diagnosis_data['id'] = doc.id
-                history.append(diagnosis_data)
-            
-            # Sort by created_at descending (most recent first)
-            history.sort(key=lambda x: x.get('created_at', datetime.min), reverse=True)
-            return history
-            
-        except Exception as e:
-            print(f"Error getting patient history: {e}")
-            return []
+        history = []
+        docs = self.db.collection('diagnoses').where('user_id', '==', user_id).get()
+        for doc in docs:
+            diagnosis_data = doc.to_dict()
+            diagnosis_data['id'] = doc.id
+            history.append(diagnosis_data)
+        
+        # Sort by created_at descending (most recent first)
+        history.sort(key=lambda x: x.get('created_at', datetime.min), reverse=True)
+        return history
     
+    @write_operation(default=False)
     def update_diagnosis_status(self, diagnosis_id, status):
         """Update diagnosis status (active, resolved, etc.)"""
         if not self.db:
             return False
         
-        try:
-            self.db.collection('diagnoses').document(diagnosis_id).update({
-                'status': status,
-                'updated_at': datetime.utcnow()
-            })
-            return True
-        except Exception as e:
-            print(f"Error updating diagnosis status: {e}")
-            return False
+        diagnosis_ref = self.db.collection('diagnoses').document(diagnosis_id)
+        snapshot = diagnosis_ref.get(['user_id'])
+        if not snapshot.exists:
+            raise Exception(f"Diagnosis {diagnosis_id} not found")
+        
+        batch = self.db.batch()
+        batch.update(diagnosis_ref, {
+            'status': status,
+            'updated_at': datetime.utcnow()
+        })
+        self._set_timeline_status(batch, snapshot.get('user_id'), 'diagnoses', [diagnosis_id], status)
+        batch.commit()
+        return True
+
+    # Patient Timelines
+    def _timeline_ref(self, user_id):
+        return self.db.collection('patient_timelines').document(user_id)
+    
+    def _timeline_entry(self, kind, data):
+        return {field: data.get(field) for field in self.TIMELINE_FIELDS[kind]}
+    
+    @staticmethod
+    def _timeline_events(events):
+        """Complete entries of a timeline map as a list, newest first"""
+        entries = [dict(entry, id=event_id) for event_id, entry in (events or {}).items() if entry.get('created_at')]
+        entries.sort(key=_event_time, reverse=True)
+        return entries[:TIMELINE_LIMIT]
+    
+    def _trim_events(self, events):
+        return {entry.pop('id'): entry for entry in self._timeline_events(events)}
+    
+    def _add_timeline_event(self, transaction, timeline_snapshot, kind, event_id, data):
+        """Insert a new event into a timeline read earlier in the same transaction"""
+        self._add_timeline_events(transaction, timeline_snapshot, kind, {event_id: data})
+    
+    def _add_timeline_events(self, transaction, timeline_snapshot, kind, new_events):
+        timeline = timeline_snapshot.to_dict() if timeline_snapshot.exists else {}
+        if not timeline.get('built_at'):
+            # Not built yet; the first read rebuilds it from the source collections
+            return
+        
+        events = dict(timeline.get(kind) or {})
+        for event_id, data in new_events.items():
+            events[event_id] = self._timeline_entry(kind, data)
+        transaction.update(timeline_snapshot.reference, {
+            kind: self._trim_events(events),
+            'updated_at': datetime.utcnow()
+        })
+    
+    def _set_timeline_status(self, writer, user_id, kind, event_ids, status):
+        """Patch event statuses in a patient's timeline from a batch or transaction, without reading it"""
+        if not user_id:
+            return
+        now = datetime.utcnow()
+        # Entries that were already trimmed come back partial and are dropped on read
+        writer.set(self._timeline_ref(user_id), {
+            kind: {event_id: {'status': status, 'updated_at': now} for event_id in event_ids},
+            'updated_at': now
+        }, merge=True)
+    
+    def rebuild_patient_timeline(self, user_id):
+        """Rebuild a patient's timeline document from their live and archived appointments and diagnoses"""
+        timeline_ref = self._timeline_ref(user_id)
+        queries = {kind: self.db.collection(kind).where('user_id', '==', user_id) for kind in self.TIMELINE_FIELDS}
+        # Archived appointments never change, so they are read once outside the transaction
+        archived = {appointment.pop('id'): self._timeline_entry('appointments', appointment)
+                    for appointment in self.stream_archived_appointments(user_id=user_id)}
+        
+        @firestore.transactional
+        def rebuild(transaction):
+            now = datetime.utcnow()
+            timeline = {}
+            for kind, query in queries.items():
+                events = dict(archived) if kind == 'appointments' else {}
+                events.update({doc.id: self._timeline_entry(kind, doc.to_dict()) for doc in transaction.get(query)})
+                timeline[kind] = self._trim_events(events)
+            timeline.update({'built_at': now, 'updated_at': now})
+            transaction.set(timeline_ref, timeline)
+            return timeline
+        
+        return rebuild(self.db.transaction())
+    
+    @read_operation(default=lambda: {kind: [] for kind in FirebaseDB.TIMELINE_FIELDS})
+    def get_patient_timeline(self, user_id):
+        """A patient's recent appointments and diagnoses, newest first, from one document read"""
+        timeline = {kind: [] for kind in self.TIMELINE_FIELDS}
+        if not self.db:
+            return timeline
+        
+        snapshot = self._timeline_ref(user_id).get()
+        data = snapshot.to_dict() if snapshot.exists else {}
+        if not data.get('built_at'):
+            print(f"Firebase: Building timeline for user {user_id}")
+            data = self.rebuild_patient_timeline(user_id)
+        return {kind: self._timeline_events(data.get(kind)) for kind in self.TIMELINE_FIELDS}
 
     # Appointment Management
+    @write_operation()
     def create_appointment(self, user_id, service, date, time, notes=None, attachment_url=None, attachment_filename=None):
         """Create a new appointment"""
         if not self.db:
             raise Exception("Firestore not initialized")
         
-        try:
-            appointment_data = {
-                'user_id': user_id,
+        appointment_data = {
+            'user_id': user_id,
+            'service': service,
+            'date': date.isoformat() if hasattr(date, 'isoformat') else str(date),
+            'time': time.isoformat() if hasattr(time, 'isoformat') else str(time),
+            'notes': notes,
+            'notes_preview': notes_preview(notes),
+            'status': 'pending',
+            'attachment_url': attachment_url,
+            'attachment_filename': attachment_filename,
+            'created_at': datetime.utcnow()
+        }
+        
+        print(f"Firebase: Creating appointment with data: {appointment_data}")
+        appointment_ref = self.db.collection('appointments').document()
+        timeline_ref = self._timeline_ref(user_id)
+        
+        @firestore.transactional
+        def create(transaction):
+            timeline_snapshot = timeline_ref.get(transaction=transaction)
+            transaction.create(appointment_ref, appointment_data)
+            self._add_timeline_event(transaction, timeline_snapshot, 'appointments', appointment_ref.id, appointment_data)
+            self._apply_rollup_deltas(transaction, {self._rollup_key(appointment_data): 1})
+        
+        create(self.db.transaction())
+        appointment_data['id'] = appointment_ref.id
+        print(f"Firebase: Appointment created with ID: {appointment_data['id']}")
+        return appointment_data
+    
+    @write_operation(propagate=(SlotUnavailableError,))
+    def book_appointment_slot(self, user_id, service, date, time, notes=None, attachment_url=None, attachment_filename=None):
+        """Claim a slot and create its appointment in one transaction"""
+        if not self.db:
+            raise Exception("Firestore not initialized")
+        
+        index = slot_index(time)
+        if index is None or not is_clinic_day(date):
+            raise SlotUnavailableError("Requested time is outside clinic hours")
+        
+        slot_ref = self.db.collection('appointment_slots').document(slot_document_id(date, service))
+        appointment_ref = self.db.collection('appointments').document()
+        timeline_ref = self._timeline_ref(user_id)
+        appointment_data = self._slot_appointment_data(user_id, service, date, time, notes, attachment_url,
+                                                       attachment_filename, slot_ref.id, index)
+        
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = slot_ref.get(transaction=transaction)
+            booked_mask = (snapshot.get('booked_mask') or 0) if snapshot.exists else 0
+            if booked_mask & (1 << index):
+                raise SlotUnavailableError("That time slot has just been booked")
+            timeline_snapshot = timeline_ref.get(transaction=transaction)
+            
+            transaction.set(slot_ref, {
+                'date': date.isoformat(),
                 'service': service,
-                'date': date.isoformat() if hasattr(date, 'isoformat') else str(date),
-                'time': time.isoformat() if hasattr(time, 'isoformat') else str(time),
-                'notes': notes,
-                'status': 'pending',
-                'attachment_url': attachment_url,
-                'attachment_filename': attachment_filename,
-                'created_at': datetime.utcnow()
-            }
+                'booked_mask': booked_mask | (1 << index),
+                'updated_at': datetime.utcnow()
+            }, merge=True)
+            transaction.create(appointment_ref, appointment_data)
+            self._add_timeline_event(transaction, timeline_snapshot, 'appointments', appointment_ref.id, appointment_data)
+            self._apply_rollup_deltas(transaction, {self._rollup_key(appointment_data): 1})
+        
+        claim(self.db.transaction())
+        appointment_data['id'] = appointment_ref.id
+        print(f"Firebase: Appointment {appointment_ref.id} booked in slot {slot_ref.id}#{index}")
+        return appointment_data
+    
+    @staticmethod
+    def _slot_appointment_data(user_id, service, date, time, notes, attachment_url, attachment_filename, slot_id, index, created_at=None):
+        return {
+            'user_id': user_id,
+            'service': service,
+            'date': date.isoformat(),
+            'time': time.strftime('%H:%M:%S'),
+            'notes': notes,
+            'notes_preview': notes_preview(notes),
+            'status': 'pending',
+            'attachment_url': attachment_url,
+            'attachment_filename': attachment_filename,
+            'slot_id': slot_id,
+            'slot_index': index,
+            'created_at': created_at or datetime.utcnow()
+        }
+    
+    @write_operation(propagate=(Exception,))
+    def commit_queued_bookings(self, bookings):
+        """Commit journaled bookings in one transaction; returns {key: (outcome, error)}"""
+        if not self.db:
+            raise Exception("Firestore not initialized")
+        
+        # Each idempotency key is also the appointment document ID, so a retried
+        # batch recognises bookings an earlier attempt already committed
+        plans = []
+        for booking in bookings:
+            day = datetime.strptime(booking['date'], '%Y-%m-%d').date()
+            start = datetime.strptime(booking['time'], '%H:%M:%S').time()
+            index = slot_index(start)
+            slot_ref = None
+            if index is not None and is_clinic_day(day):
+                slot_ref = self.db.collection('appointment_slots').document(slot_document_id(day, booking['service']))
+            plans.append((booking, day, start, self.db.collection('appointments').document(booking['key']), slot_ref, index))
+        
+        slot_refs = {plan[4].id: plan[4] for plan in plans if plan[4] is not None}
+        timeline_refs = [self._timeline_ref(user_id) for user_id in {booking['user_id'] for booking in bookings}]
+        
+        @firestore.transactional
+        def commit(transaction):
+            existing = {snapshot.id for snapshot in transaction.get_all([plan[3] for plan in plans]) if snapshot.exists}
+            masks = {}
+            if slot_refs:
+                for snapshot in transaction.get_all(list(slot_refs.values())):
+                    masks[snapshot.id] = ((snapshot.to_dict() or {}).get('booked_mask') or 0) if snapshot.exists else 0
+            timelines = {snapshot.id: snapshot for snapshot in transaction.get_all(timeline_refs)}
             
-            print(f"Firebase: Creating appointment with data: {appointment_data}")
-            doc_ref = self.db.collection('appointments').add(appointment_data)
-            appointment_data['id'] = doc_ref[1].id
-            print(f"Firebase: Appointment created with ID: {appointment_data['id']}")
-            return appointment_data
+            # All reads are done; decide each booking in journal order, then write
+            results = {}
+            claimed_slots = {}
+            new_events = {}
+            rollup_deltas = {}
+            for booking, day, start, appointment_ref, slot_ref, index in plans:
+                key = booking['key']
+                if key in existing:
+                    results[key] = ('committed', None)
+                    continue
+                if slot_ref is None:
+                    results[key] = ('conflict', 'Requested time is outside clinic hours')
+                    continue
+                if masks[slot_ref.id] & (1 << index):
+                    results[key] = ('conflict', 'That time slot has already been booked')
+                    continue
+                
+                masks[slot_ref.id] |= 1 << index
+                claimed_slots[slot_ref.id] = (day, booking['service'])
+                appointment_data = self._slot_appointment_data(
+                    booking['user_id'], booking['service'], day, start, booking.get('notes'),
+                    booking.get('attachment_url'), booking.get('attachment_filename'), slot_ref.id, index,
+                    created_at=datetime.fromisoformat(booking['created_at']) if booking.get('created_at') else None
+                )
+                transaction.create(appointment_ref, appointment_data)
+                new_events.setdefault(booking['user_id'], {})[key] = appointment_data
+                rollup_key = self._rollup_key(appointment_data)
+                rollup_deltas[rollup_key] = rollup_deltas.get(rollup_key, 0) + 1
+                results[key] = ('committed', None)
             
-        except Exception as e:
-            print(f"Error creating appointment: {e}")
-            return None
+            for slot_id, (day, service) in claimed_slots.items():
+                transaction.set(slot_refs[slot_id], {
+                    'date': day.isoformat(),
+                    'service': service,
+                    'booked_mask': masks[slot_id],
+                    'updated_at': datetime.utcnow()
+                }, merge=True)
+            for user_id, events in new_events.items():
+                self._add_timeline_events(transaction, timelines[user_id], 'appointments', events)
+            self._apply_rollup_deltas(transaction, rollup_deltas)
+            return results
+        
+        return commit(self.db.transaction())
+    
+    @read_operation(default=0)
+    def get_slot_mask(self, date, service):
+        """Get the booked-slot bitmap for a day and service (one document read)"""
+        if not self.db:
+            return 0
+        
+        snapshot = self.db.collection('appointment_slots').document(slot_document_id(date, service)).get()
+        if snapshot.exists:
+            return snapshot.get('booked_mask') or 0
+        return 0
     
+    def _release_slot(self, appointment_id, status):
+        """Update an appointment's status and free its slot in one transaction"""
+        appointment_ref = self.db.collection('appointments').document(appointment_id)
+        
+        @firestore.transactional
+        def release(transaction):
+            snapshot = appointment_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                raise Exception(f"Appointment {appointment_id} not found")
+            
+            appointment_data = snapshot.to_dict()
+            slot_id = appointment_data.get('slot_id')
+            index = appointment_data.get('slot_index')
+            slot_ref = None
+            slot_snapshot = None
+            if slot_id and index is not None and appointment_data.get('status') != 'cancelled':
+                slot_ref = self.db.collection('appointment_slots').document(slot_id)
+                slot_snapshot = slot_ref.get(transaction=transaction)
+            
+            # All reads happen before any writes in a Firestore transaction
+            if slot_snapshot is not None and slot_snapshot.exists:
+                booked_mask = slot_snapshot.get('booked_mask') or 0
+                transaction.update(slot_ref, {
+                    'booked_mask': booked_mask & ~(1 << index),
+                    'updated_at': datetime.utcnow()
+                })
+            transaction.update(appointment_ref, {
+                'status': status,
+                'updated_at': datetime.utcnow()
+            })
+            self._set_timeline_status(transaction, appointment_data.get('user_id'), 'appointments', [appointment_id], status)
+            self._apply_rollup_deltas(transaction, self._status_change_deltas([appointment_data], status))
+        
+        release(self.db.transaction())
+    
+    @read_operation(default=list)
     def get_appointments_by_user(self, user_id):
         """Get appointments for a specific user"""
         if not self.db:
             return []
         
-        try:
-            appointments = []
-            print(f"Firebase: Searching for appointments with user_id: {user_id}")
-            docs = self.db.collection('appointments').where('user_id', '==', user_id).get()
-            print(f"Firebase: Found {len(docs)} documents")
-            for doc in docs:
-                appointment_data = doc.to_dict()
-                appointment_data['id'] = doc.id
-                print(f"Firebase: Appointment data: {appointment_data}")
-                appointments.append(appointment_data)
-            return appointments
-        except Exception as e:
-            print(f"Error getting user appointments: {e}")
-            return []
+        appointments = []
+        print(f"Firebase: Searching for appointments with user_id: {user_id}")
+        docs = self.db.collection('appointments').where('user_id', '==', user_id).get()
+        print(f"Firebase: Found {len(docs)} documents")
+        for doc in docs:
+            appointment_data = doc.to_dict()
+            appointment_data['id'] = doc.id
+            print(f"Firebase: Appointment data: {appointment_data}")
+            appointments.append(appointment_data)
+        return appointments
     
+    @read_operation(default=list)
     def get_all_appointments(self):
-        """Get all appointments"""
+        """Get all appointments as lightweight rows with patient summaries"""
         if not self.db:
             return []
         
-        try:
-            appointments = []
-            docs = self.db.collection('appointments').get()
-            for doc in docs:
-                appointment_data = doc.to_dict()
-                appointment_data['id'] = doc.id
-                # Get user data for this appointment
-                user_data = self.get_user_by_id(appointment_data['user_id'])
-                appointment_data['user'] = user_data
-                appointments.append(appointment_data)
-            return appointments
-        except Exception as e:
-            print(f"Error getting all appointments: {e}")
-            return []
+        return list(self.stream_appointment_rows())
     
+    def stream_appointment_rows(self, page_size=500, first_page_size=50):
+        """Yield appointment rows with patient summaries, newest first, one page at a time; read errors propagate"""
+        if not self.db:
+            return
+        
+        query = self.db.collection('appointments').select(self.APPOINTMENT_LIST_FIELDS).order_by('created_at', direction=firestore.Query.DESCENDING)
+        for docs in self._pages(query, page_size, first_page_size):
+            # Patients are joined a page at a time, in one batched read each
+            yield from self._attach_users([self.AppointmentRow(doc.id, doc.to_dict()) for doc in docs])
+    
+    @read_operation()
     def get_appointment_by_id(self, appointment_id):
         """Get appointment by ID"""
         if not self.db:
             return None
         
-        try:
-            doc = self.db.collection('appointments').document(appointment_id).get()
-            if doc.exists:
-                appointment_data = doc.to_dict()
-                appointment_data['id'] = doc.id
-                # Get user data for this appointment
-                user_data = self.get_user_by_id(appointment_data['user_id'])
-                appointment_data['user'] = user_data
-                return appointment_data
-            return None
-        except Exception as e:
-            print(f"Error getting appointment by ID: {e}")
-            return None
+        doc = self.db.collection('appointments').document(appointment_id).get()
+        if doc.exists:
+            appointment_data = doc.to_dict()
+            appointment_data['id'] = doc.id
+            # Get the patient's name and email for this appointment
+            appointment_data['user'] = self.get_user_summaries([appointment_data['user_id']]).get(appointment_data['user_id'])
+            return appointment_data
+        return None
     
+    @write_operation(default=False, propagate=(InvalidStatusTransitionError,))
     def update_appointment_status(self, appointment_id, status):
         """Update appointment status"""
         if not self.db:
             return False
         
-        try:
-            self.db.collection('appointments').document(appointment_id).update({
+        if status == 'cancelled':
+            # Cancelling hands the slot back to the availability bitmap
+            self._release_slot(appointment_id, status)
+        else:
+            appointment_ref = self.db.collection('appointments').document(appointment_id)
+            snapshot = appointment_ref.get(self.ROLLUP_SOURCE_FIELDS)
+            if not snapshot.exists:
+                raise Exception(f"Appointment {appointment_id} not found")
+            check_status_transition(snapshot.get('status'), status)
+            
+            batch = self.db.batch()
+            # Rejected if the appointment changed since it was read, so a transition is never counted twice
+            batch.update(appointment_ref, {
                 'status': status,
                 'updated_at': datetime.utcnow()
-            })
-            return True
-        except Exception as e:
-            print(f"Error updating appointment status: {e}")
-            return False
+            }, option=self.db.write_option(last_update_time=snapshot.update_time))
+            self._set_timeline_status(batch, snapshot.get('user_id'), 'appointments', [appointment_id], status)
+            self._apply_rollup_deltas(batch, self._status_change_deltas([snapshot.to_dict()], status))
+            batch.commit()
+        return True
+    
+    def bulk_update_appointment_status(self, appointment_ids, status, chunk_size=500):
+        """Update many appointments' status in batched writes; returns updated IDs and per-ID failures"""
+        result = {'updated': [], 'failed': {}}
+        appointment_ids = list(dict.fromkeys(appointment_ids))  # de-duplicate, keep order
+        if not self.db:
+            result['failed'] = {appointment_id: 'Firestore not initialized' for appointment_id in appointment_ids}
+            return result
+        
+        # Each appointment may also write its patient's timeline, a report rollup (and, when
+        # cancelling, a slot document); all of a chunk's writes must fit the 500-write limit
+        chunk_size = min(chunk_size, 120 if status == 'cancelled' else 160)
+        
+        for start in range(0, len(appointment_ids), chunk_size):
+            chunk = appointment_ids[start:start + chunk_size]
+            try:
+                if status == 'cancelled':
+                    updated, failed = self._cancel_appointments_chunk(chunk)
+                else:
+                    updated, failed = self._update_status_chunk(chunk, status)
+            except Exception as e:
+                print(f"Error committing appointment status batch: {e}")
+                updated, failed = [], {appointment_id: str(e) for appointment_id in chunk}
+            result['updated'].extend(updated)
+            result['failed'].update(failed)
+        
+        print(f"Firebase: Bulk status '{status}': {len(result['updated'])} updated, {len(result['failed'])} failed")
+        return result
     
+    @write_operation(propagate=(Exception,))
+    def _update_status_chunk(self, appointment_ids, status):
+        refs = [self.db.collection('appointments').document(appointment_id) for appointment_id in appointment_ids]
+        existing = {snapshot.id: snapshot for snapshot in self.db.get_all(refs, field_paths=self.ROLLUP_SOURCE_FIELDS) if snapshot.exists}
+        failed = {ref.id: 'Appointment not found' for ref in refs if ref.id not in existing}
+        for appointment_id, snapshot in list(existing.items()):
+            try:
+                check_status_transition(snapshot.get('status'), status)
+            except InvalidStatusTransitionError as e:
+                failed[appointment_id] = str(e)
+                del existing[appointment_id]
+        
+        batch = self.db.batch()
+        updated = []
+        by_user = {}
+        for ref in refs:
+            if ref.id in existing:
+                snapshot = existing[ref.id]
+                # The whole chunk is rejected if any appointment changed since it was read
+                batch.update(ref, {'status': status, 'updated_at': datetime.utcnow()},
+                             option=self.db.write_option(last_update_time=snapshot.update_time))
+                updated.append(ref.id)
+                by_user.setdefault(snapshot.get('user_id'), []).append(ref.id)
+        for user_id, user_appointment_ids in by_user.items():
+            self._set_timeline_status(batch, user_id, 'appointments', user_appointment_ids, status)
+        self._apply_rollup_deltas(batch, self._status_change_deltas([snapshot.to_dict() for snapshot in existing.values()], status))
+        if updated:
+            batch.commit()
+        return updated, failed
+    
+    @write_operation(propagate=(Exception,))
+    def _cancel_appointments_chunk(self, appointment_ids):
+        refs = [self.db.collection('appointments').document(appointment_id) for appointment_id in appointment_ids]
+        
+        @firestore.transactional
+        def cancel(transaction):
+            failed = {}
+            to_cancel = []
+            cancelled_data = []
+            released = {}
+            by_user = {}
+            for snapshot in transaction.get_all(refs):
+                if not snapshot.exists:
+                    failed[snapshot.id] = 'Appointment not found'
+                    continue
+                appointment_data = snapshot.to_dict()
+                to_cancel.append(snapshot.reference)
+                cancelled_data.append(appointment_data)
+                by_user.setdefault(appointment_data.get('user_id'), []).append(snapshot.id)
+                slot_id = appointment_data.get('slot_id')
+                index = appointment_data.get('slot_index')
+                if slot_id and index is not None and appointment_data.get('status') != 'cancelled':
+                    released[slot_id] = released.get(slot_id, 0) | (1 << index)
+            
+            # Slot bitmaps are read inside the transaction so concurrent bookings aren't overwritten
+            slot_refs = [self.db.collection('appointment_slots').document(slot_id) for slot_id in released]
+            slot_masks = {}
+            if slot_refs:
+                for snapshot in transaction.get_all(slot_refs):
+                    if snapshot.exists:
+                        slot_masks[snapshot.id] = (snapshot.reference, snapshot.get('booked_mask') or 0)
+            
+            for slot_id, (slot_ref, booked_mask) in slot_masks.items():
+                transaction.update(slot_ref, {
+                    'booked_mask': booked_mask & ~released[slot_id],
+                    'updated_at': datetime.utcnow()
+                })
+            for ref in to_cancel:
+                transaction.update(ref, {'status': 'cancelled', 'updated_at': datetime.utcnow()})
+            for user_id, user_appointment_ids in by_user.items():
+                self._set_timeline_status(transaction, user_id, 'appointments', user_appointment_ids, 'cancelled')
+            self._apply_rollup_deltas(transaction, self._status_change_deltas(cancelled_data, 'cancelled'))
+            return [ref.id for ref in to_cancel], failed
+        
+        return cancel(self.db.transaction())
+    
+    @read_operation(default=list)
     def get_recent_appointments(self, limit=5):
         """Get recent appointments"""
         if not self.db:
             return []
         
-        try:
-            appointments = []
-            print(f"Firebase: Getting recent appointments (limit: {limit})")
-            # Remove order_by to avoid index requirement, then sort in Python
-            docs = self.db.collection('appointments').get()
-            print(f"Firebase: Found {len(docs)} total appointments")
+        print(f"Firebase: Getting recent appointments (limit: {limit})")
+        # created_at has a single-field index, so this reads only `limit` documents
+        query = (self.db.collection('appointments')
+                 .select(self.APPOINTMENT_LIST_FIELDS)
+                 .order_by('created_at', direction=firestore.Query.DESCENDING)
+                 .limit(limit))
+        appointments = self._attach_users([self.AppointmentRow(doc.id, doc.to_dict()) for doc in query.stream()])
+        print(f"Firebase: Returning {len(appointments)} recent appointments")
+        return appointments
+    
+    def backfill_notes_previews(self, page_size=500):
+        """Populate notes_preview on appointments written before list projections existed"""
+        if not self.db:
+            return 0
+        
+        updated = 0
+        query = self.db.collection('appointments').select(['notes', 'notes_preview']).order_by('__name__')
+        batch = self.db.batch()
+        pending = 0
+        for doc in self._stream_paginated(query, page_size):
+            data = doc.to_dict()
+            preview = notes_preview(data.get('notes'))
+            if data.get('notes_preview') != preview:
+                batch.update(doc.reference, {'notes_preview': preview})
+                pending += 1
+                updated += 1
+            if pending == 500:
+                firestore_guard.call(batch.commit, FIRESTORE_BATCH_TIMEOUT)
+                batch = self.db.batch()
+                pending = 0
+        if pending:
+            firestore_guard.call(batch.commit, FIRESTORE_BATCH_TIMEOUT)
+        print(f"Firebase: Backfilled notes_preview on {updated} appointments")
+        return updated
+    
+    def backfill_appointment_slots(self, page_size=500):
+        """Claim slot bits for upcoming appointments booked before slot bitmaps existed; returns how many"""
+        if not self.db:
+            return 0
+        
+        # Only upcoming, still-open appointments can collide with a new booking
+        today = datetime.utcnow().date().isoformat()
+        legacy = {}
+        query = self.db.collection('appointments').select(['service', 'date', 'time', 'status', 'slot_id']).order_by('__name__')
+        for doc in self._stream_paginated(query, page_size):
+            data = doc.to_dict()
+            if data.get('slot_id') or data.get('status') == 'cancelled' or (data.get('date') or '') < today:
+                continue
+            try:
+                day = datetime.strptime(data['date'], '%Y-%m-%d').date()
+                index = slot_index(data.get('time') or '')
+            except (KeyError, ValueError):
+                continue
+            if index is None or not is_clinic_day(day) or not data.get('service'):
+                continue
+            slot_id = slot_document_id(day, data['service'])
+            legacy.setdefault(slot_id, (day, data['service'], []))[2].append((doc.reference, index))
+        
+        # One transaction per slot document: OR the bits into whatever new bookings set already,
+        # and stamp each appointment so cancelling it hands the slot back
+        @firestore.transactional
+        def claim(transaction, slot_ref, day, service, appointments):
+            snapshot = slot_ref.get(transaction=transaction)
+            booked_mask = (snapshot.get('booked_mask') or 0) if snapshot.exists else 0
+            for _, index in appointments:
+                booked_mask |= 1 << index
+            transaction.set(slot_ref, {
+                'date': day.isoformat(),
+                'service': service,
+                'booked_mask': booked_mask,
+                'updated_at': datetime.utcnow()
+            }, merge=True)
+            for appointment_ref, index in appointments:
+                transaction.update(appointment_ref, {'slot_id': slot_ref.id, 'slot_index': index})
+        
+        claimed = 0
+        for slot_id, (day, service, appointments) in legacy.items():
+            slot_ref = self.db.collection('appointment_slots').document(slot_id)
+            firestore_guard.call(lambda: claim(self.db.transaction(), slot_ref, day, service, appointments),
+                                 FIRESTORE_BATCH_TIMEOUT)
+            claimed += len(appointments)
+        print(f"Firebase: Backfilled {claimed} appointments into {len(legacy)} slot bitmaps")
+        return claimed
+    
+    # Exports
+    def _pages(self, query, page_size=500, first_page_size=None):
+        """Yield an ordered query's documents as lists, page by page using cursors; each page read is guarded"""
+        last_doc = None
+        # A small first page gets the first rows of a streamed page out sooner
+        limit = first_page_size or page_size
+        while True:
+            page_query = query.limit(limit)
+            if last_doc is not None:
+                page_query = page_query.start_after(last_doc)
+            
+            docs = firestore_guard.call(lambda: list(page_query.stream()), FIRESTORE_BATCH_TIMEOUT, retries=FIRESTORE_READ_RETRIES)
+            if docs:
+                yield docs
             
-            # Convert to list and sort by created_at
-            all_appointments = []
+            if len(docs) < limit:
+                return
+            last_doc = docs[-1]
+            limit = page_size
+    
+    def _stream_paginated(self, query, page_size=500, first_page_size=None):
+        """Yield documents from an ordered query page by page using cursors"""
+        for docs in self._pages(query, page_size, first_page_size):
+            yield from docs
+    
+    def stream_appointments(self, start_date=None, end_date=None, status=None, page_size=500):
+        """Stream appointments, optionally filtered by appointment date range (inclusive) and status"""
+        if not self.db:
+            return
+        
+        query = self.db.collection('appointments')
+        if status:
+            query = query.where('status', '==', status)
+        if start_date:
+            query = query.where('date', '>=', start_date.isoformat())
+        if end_date:
+            query = query.where('date', '<=', end_date.isoformat())
+        query = query.order_by('date')
+        
+        for doc in self._stream_paginated(query, page_size):
+            appointment_data = doc.to_dict()
+            appointment_data['id'] = doc.id
+            yield appointment_data
+    
+    def stream_diagnoses(self, user_id=None, start_date=None, end_date=None, status=None, page_size=500):
+        """Stream diagnoses (patient histories), optionally filtered by patient, creation date and status"""
+        if not self.db:
+            return
+        
+        query = self.db.collection('diagnoses')
+        if user_id:
+            query = query.where('user_id', '==', user_id)
+        if status:
+            query = query.where('status', '==', status)
+        if start_date:
+            query = query.where('created_at', '>=', datetime.combine(start_date, datetime.min.time()))
+        if end_date:
+            query = query.where('created_at', '<=', datetime.combine(end_date, datetime.max.time()))
+        query = query.order_by('created_at')
+        
+        for doc in self._stream_paginated(query, page_size):
+            diagnosis_data = doc.to_dict()
+            diagnosis_data['id'] = doc.id
+            yield diagnosis_data
+    
+    # Appointment Reminders
+    # appointment_reminders/{appointment_id} marks a reminder as claimed, sent or failed,
+    # so overlapping or repeated runs never email a patient twice.
+    REMINDER_FIELDS = ('user_id', 'service', 'date', 'time', 'status')
+    
+    def stream_reminder_candidates(self, first_day, last_day, statuses=('pending', 'confirmed'), page_size=500):
+        """Appointments dated first_day..last_day (inclusive) that are still going ahead"""
+        if not self.db:
+            return
+        
+        query = (self.db.collection('appointments')
+                 .select(self.REMINDER_FIELDS)
+                 .where('status', 'in', list(statuses))
+                 .where('date', '>=', first_day.isoformat())
+                 .where('date', '<=', last_day.isoformat())
+                 .order_by('date'))
+        for doc in self._stream_paginated(query, page_size):
+            appointment_data = doc.to_dict()
+            appointment_data['id'] = doc.id
+            yield appointment_data
+    
+    @write_operation(propagate=(Exception,))
+    def claim_reminders(self, appointment_ids, lease_seconds=900):
+        """Atomically mark reminders as claimed; returns the IDs this caller may send"""
+        if not self.db or not appointment_ids:
+            return []
+        
+        refs = [self.db.collection('appointment_reminders').document(appointment_id) for appointment_id in appointment_ids]
+        lease_cutoff = datetime.now(timezone.utc) - timedelta(seconds=lease_seconds)
+        
+        @firestore.transactional
+        def claim(transaction):
+            claimed = []
+            for snapshot in transaction.get_all(refs):
+                # Failed sends may be retried, and so may claims whose run died before marking them;
+                # sent ones and live claims belong to another run
+                if snapshot.exists:
+                    reminder = snapshot.to_dict()
+                    claimed_at = reminder.get('claimed_at')
+                    if reminder.get('status') == 'sent' or (reminder.get('status') == 'claimed' and claimed_at and claimed_at > lease_cutoff):
+                        continue
+                transaction.set(snapshot.reference, {'status': 'claimed', 'claimed_at': datetime.utcnow()})
+                claimed.append(snapshot.id)
+            return claimed
+        
+        return claim(self.db.transaction())
+    
+    @write_operation(propagate=(Exception,))
+    def mark_reminders(self, sent_ids, failed=None):
+        """Record delivery results for claimed reminders in one batch"""
+        if not self.db or not (sent_ids or failed):
+            return
+        
+        now = datetime.utcnow()
+        batch = self.db.batch()
+        for appointment_id in sent_ids:
+            batch.update(self.db.collection('appointment_reminders').document(appointment_id), {'status': 'sent', 'sent_at': now})
+        for appointment_id, error in (failed or {}).items():
+            batch.update(self.db.collection('appointment_reminders').document(appointment_id), {
+                'status': 'failed',
+                'error': str(error)[:500],
+                'failed_at': now
+            })
+        batch.commit()
+    
+    # Appointment Archive
+    # appointment_archive/{YYYY-MM} holds a running count; its archived_appointments
+    # subcollection holds that month's appointments (partitioned by appointment date).
+    def _archive_ref(self, month):
+        return self.db.collection('appointment_archive').document(month)
+    
+    def archive_appointments(self, older_than_days=None, chunk_size=200, max_chunks=None, dry_run=False):
+        """Move appointments dated before the cutoff out of the live collection; returns how many moved"""
+        if not self.db:
+            return 0
+        
+        days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+        cutoff = (datetime.utcnow().date() - timedelta(days=days)).isoformat()
+        query = self.db.collection('appointments').where('date', '<', cutoff)
+        if dry_run:
+            return firestore_guard.call(lambda: self._count(query), FIRESTORE_BATCH_TIMEOUT)
+        
+        archived = 0
+        chunks = 0
+        failures = 0
+        # Archived documents leave the query, so each pass just takes the next chunk
+        query = query.order_by('date').limit(chunk_size)
+        while max_chunks is None or chunks < max_chunks:
+            docs = firestore_guard.call(lambda: list(query.stream()), FIRESTORE_BATCH_TIMEOUT, retries=FIRESTORE_READ_RETRIES)
+            if not docs:
+                break
+            
+            now = datetime.utcnow()
+            batch = self.db.batch()
+            per_month = {}
             for doc in docs:
                 appointment_data = doc.to_dict()
-                appointment_data['id'] = doc.id
-                # Get user data for this appointment
-                user_data = self.get_user_by_id(appointment_data['user_id'])
-                appointment_data['user'] = user_data
-                all_appointments.append(appointment_data)
+                month = appointment_data['date'][:7]
+                appointment_data['archived_at'] = now
+                batch.set(self._archive_ref(month).collection('archived_appointments').document(doc.id), appointment_data)
+                # Skip the chunk if the appointment changed (or another run moved it) since it was read
+                batch.delete(doc.reference, option=self.db.write_option(last_update_time=doc.update_time))
+                per_month[month] = per_month.get(month, 0) + 1
+            for month, count in per_month.items():
+                batch.set(self._archive_ref(month), {
+                    'month': month,
+                    'count': firestore.Increment(count),
+                    'updated_at': now
+                }, merge=True)
             
-            # Sort by created_at descending and take limit
-            all_appointments.sort(key=lambda x: x.get('created_at', datetime.min), reverse=True)
-            appointments = all_appointments[:limit]
-            print(f"Firebase: Returning {len(appointments)} recent appointments")
-            return appointments
-        except Exception as e:
-            print(f"Error getting recent appointments: {e}")
+            try:
+                firestore_guard.call(batch.commit, FIRESTORE_BATCH_TIMEOUT)
+            except Exception as e:
+                failures += 1
+                print(f"Error archiving appointment chunk (attempt {failures}): {e}")
+                if failures >= 3:
+                    break
+                continue
+            
+            archived += len(docs)
+            chunks += 1
+            failures = 0
+        
+        print(f"Firebase: Archived {archived} appointments dated before {cutoff}")
+        return archived
+    
+    def stream_attachment_urls(self, page_size=1000):
+        """Every attachment_url referenced by a live or archived appointment; read errors propagate"""
+        if not self.db:
+            raise Exception("Firestore not initialized")
+        
+        collections = [self.db.collection('appointments')]
+        for month in self._archive_partitions():
+            collections.append(self._archive_ref(month).collection('archived_appointments'))
+        
+        for collection in collections:
+            query = collection.where('attachment_url', '>', '').select(['attachment_url']).order_by('attachment_url')
+            for doc in self._stream_paginated(query, page_size):
+                yield doc.get('attachment_url')
+    
+    def _archive_partitions(self):
+        """Archive partition months, oldest first; unlike get_archive_months a failed read raises, so it can't hide archived data"""
+        return sorted(firestore_guard.call(
+            lambda: [doc.id for doc in self.db.collection('appointment_archive').select([]).stream()],
+            FIRESTORE_BATCH_TIMEOUT, retries=FIRESTORE_READ_RETRIES
+        ))
+    
+    @read_operation(default=list)
+    def get_archive_months(self):
+        """Archive partitions, newest first: [{'month': 'YYYY-MM', 'count': n}]"""
+        if not self.db:
             return []
+        
+        docs = self.db.collection('appointment_archive').stream()
+        months = [{'month': doc.id, 'count': doc.to_dict().get('count', 0)} for doc in docs]
+        months.sort(key=lambda partition: partition['month'], reverse=True)
+        return months
+    
+    def stream_archived_appointments(self, start_date=None, end_date=None, status=None, user_id=None, page_size=500):
+        """Stream archived appointments in date order, reading only the partitions the range covers; read errors propagate"""
+        if not self.db:
+            return
+        
+        first_month = start_date.isoformat()[:7] if start_date else None
+        last_month = end_date.isoformat()[:7] if end_date else None
+        for month in self._archive_partitions():
+            if (first_month and month < first_month) or (last_month and month > last_month):
+                continue
+            
+            query = self._archive_ref(month).collection('archived_appointments')
+            if user_id:
+                query = query.where('user_id', '==', user_id)
+            if status:
+                query = query.where('status', '==', status)
+            if start_date:
+                query = query.where('date', '>=', start_date.isoformat())
+            if end_date:
+                query = query.where('date', '<=', end_date.isoformat())
+            query = query.order_by('date')
+            
+            for doc in self._stream_paginated(query, page_size):
+                appointment_data = doc.to_dict()
+                appointment_data['id'] = doc.id
+                yield appointment_data
+    
+    @read_operation(default=0)
+    def get_archived_appointment_count(self):
+        """Total archived appointments, from the per-month counters"""
+        return sum(partition['count'] for partition in self.get_archive_months())
+    
+    # Reporting Rollups
+    # report_rollups/{YYYY-MM} holds that month's appointment counts per service and status
+    # (in total and per day of the appointment date) and its patient sign-ups. Every write
+    # that creates an appointment, changes its status or registers a patient increments the
+    # matching counters in the same commit, so reports read one document per month.
+    def _rollup_ref(self, month):
+        return self.db.collection('report_rollups').document(month)
+    
+    @staticmethod
+    def _rollup_key(appointment_data):
+        return (appointment_data.get('date') or '', appointment_data.get('service') or 'Unknown',
+                appointment_data.get('status') or 'pending')
+    
+    def _status_change_deltas(self, appointments, status):
+        """Counter deltas that move each appointment from its current status to `status`"""
+        deltas = {}
+        for appointment_data in appointments:
+            if appointment_data.get('status') == status:
+                continue
+            old_key = self._rollup_key(appointment_data)
+            new_key = old_key[:2] + (status,)
+            deltas[old_key] = deltas.get(old_key, 0) - 1
+            deltas[new_key] = deltas.get(new_key, 0) + 1
+        return deltas
+    
+    def _apply_rollup_deltas(self, writer, deltas):
+        """Queue {(date, service, status): n} increments on a batch or transaction, one write per month"""
+        per_month = {}
+        for (date, service, status), count in deltas.items():
+            if not count or len(date) < 10:
+                continue
+            month = per_month.setdefault(date[:7], {'appointments': {}, 'days': {}})
+            totals = month['appointments'].setdefault(service, {})
+            totals[status] = totals.get(status, 0) + count
+            day = month['days'].setdefault(date[8:10], {}).setdefault(service, {})
+            day[status] = day.get(status, 0) + count
+        
+        for month, counts in per_month.items():
+            writer.set(self._rollup_ref(month), {
+                'month': month,
+                'appointments': {service: {status: firestore.Increment(count) for status, count in statuses.items()}
+                                 for service, statuses in counts['appointments'].items()},
+                'days': {day: {service: {status: firestore.Increment(count) for status, count in statuses.items()}
+                               for service, statuses in services.items()}
+                         for day, services in counts['days'].items()},
+                'updated_at': datetime.utcnow()
+            }, merge=True)
+    
+    def _count_new_patient(self, writer, created_at):
+        writer.set(self._rollup_ref(created_at.strftime('%Y-%m')), {
+            'month': created_at.strftime('%Y-%m'),
+            'new_patients': firestore.Increment(1),
+            'new_patients_days': {created_at.strftime('%d'): firestore.Increment(1)},
+            'updated_at': datetime.utcnow()
+        }, merge=True)
+    
+    @read_operation(default=list)
+    def get_report_rollups(self, months):
+        """Rollup documents for the given YYYY-MM months, in the order given; missing months are empty"""
+        if not self.db:
+            return []
+        
+        refs = [self._rollup_ref(month) for month in months]
+        found = {snapshot.id: snapshot.to_dict() for snapshot in self.db.get_all(refs) if snapshot.exists}
+        return [found.get(month) or {'month': month} for month in months]
+    
+    def rebuild_report_rollups(self, page_size=500):
+        """Recount every rollup from live and archived appointments and users; returns months written.
+        
+        Run it with writes paused: increments landing during the scan are overwritten."""
+        if not self.db:
+            return 0
+        
+        rollups = {}
+        def month_doc(month):
+            return rollups.setdefault(month, {'month': month, 'appointments': {}, 'days': {},
+                                              'new_patients': 0, 'new_patients_days': {}})
+        
+        fields = ['service', 'date', 'status']
+        collections = [self.db.collection('appointments')]
+        collections.extend(self._archive_ref(month).collection('archived_appointments') for month in self._archive_partitions())
+        for collection in collections:
+            for doc in self._stream_paginated(collection.select(fields).order_by('__name__'), page_size):
+                date, service, status = self._rollup_key(doc.to_dict())
+                if len(date) < 10:
+                    continue
+                rollup = month_doc(date[:7])
+                totals = rollup['appointments'].setdefault(service, {})
+                totals[status] = totals.get(status, 0) + 1
+                day = rollup['days'].setdefault(date[8:10], {}).setdefault(service, {})
+                day[status] = day.get(status, 0) + 1
+        
+        users = self.db.collection('users').select(['is_admin', 'created_at']).order_by('__name__')
+        for doc in self._stream_paginated(users, page_size):
+            created_at = doc.get('created_at')
+            if doc.get('is_admin') or not created_at:
+                continue
+            rollup = month_doc(created_at.strftime('%Y-%m'))
+            rollup['new_patients'] += 1
+            day = created_at.strftime('%d')
+            rollup['new_patients_days'][day] = rollup['new_patients_days'].get(day, 0) + 1
+        
+        # Months that no longer have anything to count are reset rather than left stale
+        existing = firestore_guard.call(lambda: [doc.id for doc in self.db.collection('report_rollups').select([]).stream()],
+                                        FIRESTORE_BATCH_TIMEOUT, retries=FIRESTORE_READ_RETRIES)
+        for month in existing:
+            month_doc(month)
+        
+        now = datetime.utcnow()
+        months = sorted(rollups)
+        for start in range(0, len(months), 400):
+            batch = self.db.batch()
+            for month in months[start:start + 400]:
+                batch.set(self._rollup_ref(month), dict(rollups[month], updated_at=now))
+            firestore_guard.call(batch.commit, FIRESTORE_BATCH_TIMEOUT)
+        
+        print(f"Firebase: Rebuilt report rollups for {len(months)} months")
+        return len(months)
     
     # Statistics
+    # Counts are count() aggregations: Firestore tallies index entries server-side
+    # instead of sending every document to the worker.
+    @staticmethod
+    def _count(query):
+        return query.count().get()[0][0].value
+    
+    @read_operation(default=0)
     def get_user_count(self):
         """Get total user count"""
         if not self.db:
             return 0
-        
-        try:
-            users = self.db.collection('users').get()
-            return len(users)
-        except Exception as e:
-            print(f"Error getting user count: {e}")
-            return 0
+        return self._count(self.db.collection('users'))
     
-    def get_appointment_count(self):
-        """Get total appointment count"""
+    @read_operation(default=0)
+    def get_appointment_count(self, include_archived=False):
+        """Get total appointment count (live appointments unless include_archived)"""
         if not self.db:
             return 0
         
-        try:
-            appointments = self.db.collection('appointments').get()
-            return len(appointments)
-        except Exception as e:
-            print(f"Error getting appointment count: {e}")
-            return 0
+        count = self._count(self.db.collection('appointments'))
+        if include_archived:
+            return count + self.get_archived_appointment_count()
+        return count
     
+    @read_operation(default=0)
     def get_pending_appointments_count(self):
         """Get pending appointments count"""
         if not self.db:
             return 0
-        
-        try:
-            appointments = self.db.collection('appointments').where('status', '==', 'pending').get()
-            return len(appointments)
-        except Exception as e:
-            print(f"Error getting pending appointments count: {e}")
-            return 0
+        return self._count(self.db.collection('appointments').where('status', '==', 'pending'))
 
 # Global instance
 firebase_db = FirebaseDB()
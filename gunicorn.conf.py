@@ -0,0 +1,53 @@
+"""Gunicorn configuration for production.
+
+Run with: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Import the app once in the master so workers share its memory pages and boot fast.
+# The Firestore/Cloudinary clients made at import time are replaced in post_fork.
+preload_app = True
+
+# Routes spend most of their time waiting on Firestore and Cloudinary,
+# so run a few processes with several threads each
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers periodically; jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = 200
+
+accesslog = '-'
+errorlog = '-'
+
+
+def pre_fork(server, worker):
+    # Don't let a gRPC channel opened during preload (create_admin_user) leak into children
+    from firebase_db import firebase_db
+    firebase_db.close()
+
+
+def post_fork(server, worker):
+    from firebase_db import firebase_db
+    from aws_storage import cloudinary_storage
+    from appointment_feed import appointment_feed
+    from booking_queue import booking_queue
+    from patient_search import patient_search
+
+    firebase_db.reset_client()
+    cloudinary_storage.reset_connections()
+    # Snapshot listeners are per process; each worker starts its own on demand
+    appointment_feed.stop()
+    # Resume flushing any write-behind bookings journaled before a restart
+    booking_queue.start()
+    # Each worker has its own patient search index; build it now rather than on the first search
+    patient_search.start()
+    server.log.info(f"Worker {worker.pid}: Firestore and Cloudinary clients initialized")
@@ -0,0 +1,256 @@
+import os
+import re
+import heapq
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from firebase_db import firebase_db
+
+# Profile fields kept in the index; everything else stays in Firestore
+SEARCH_FIELDS = ['first_name', 'last_name', 'email', 'phone', 'patient_card_number', 'is_admin']
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# Each worker has its own index; every this many seconds it applies users created or edited
+# by any worker since its last sync (deletions wait for the next full rebuild)
+PATIENT_SEARCH_SYNC_SECONDS = int(os.environ.get('PATIENT_SEARCH_SYNC_SECONDS', 15))
+# Overlap between syncs, allowing for clock differences between the writers' updated_at stamps
+SYNC_OVERLAP = timedelta(seconds=60)
+
+
+def tokenize(user_data):
+    """Tokens a patient can be found by: name parts, email parts, phone digits and card number"""
+    tokens = set()
+    for field in ('first_name', 'last_name'):
+        tokens.update(TOKEN_PATTERN.findall((user_data.get(field) or '').lower()))
+
+    email = (user_data.get('email') or '').lower()
+    if email:
+        tokens.add(email)
+        tokens.update(TOKEN_PATTERN.findall(email))
+
+    phone = re.sub(r'\D', '', user_data.get('phone') or '')
+    if phone:
+        tokens.add(phone)
+        # Let local numbers match without the country/trunk prefix
+        for prefix in ('234', '0'):
+            if phone.startswith(prefix) and len(phone) > len(prefix) + 6:
+                tokens.add(phone[len(prefix):])
+
+    card_number = (user_data.get('patient_card_number') or '').lower()
+    if card_number:
+        tokens.add(card_number)
+        tokens.update(TOKEN_PATTERN.findall(card_number))
+    return tokens
+
+
+class TrieNode:
+    __slots__ = ('children', 'ids')
+
+    def __init__(self):
+        self.children = {}
+        self.ids = set()
+
+
+class PatientSearchIndex:
+    """In-memory inverted index and prefix trie over patient profiles"""
+
+    def __init__(self, db=None, refresh_interval=None, sync_interval=None):
+        self.firebase_db = db or firebase_db
+        self.refresh_interval = refresh_interval if refresh_interval is not None else int(os.environ.get('PATIENT_SEARCH_REFRESH_SECONDS', 600))
+        self.sync_interval = PATIENT_SEARCH_SYNC_SECONDS if sync_interval is None else sync_interval
+        self.built_at = None
+        self.synced_at = None
+        self._synced_to = None
+        self._records = {}
+        self._tokens = {}
+        self._inverted = {}
+        self._trie = TrieNode()
+        # _lock guards the index structures and is only held briefly; _build_lock
+        # serializes the slow Firestore scans so searches never wait behind one
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+
+    def start(self):
+        """Build in the background (called per worker after fork)"""
+        self._start_background(self._background_rebuild)
+
+    def build(self):
+        """(Re)build the whole index from Firestore; read errors propagate and leave the old index in place"""
+        started = time.perf_counter()
+        scan_started = datetime.now(timezone.utc)
+
+        records, tokens, inverted, trie = {}, {}, {}, TrieNode()
+        for user_data in self.firebase_db.stream_users():
+            record = self._to_record(user_data)
+            records[record['id']] = record
+            tokens[record['id']] = tokenize(record)
+            for token in tokens[record['id']]:
+                inverted.setdefault(token, set()).add(record['id'])
+                self._trie_insert(trie, token, record['id'])
+
+        with self._lock:
+            self._records, self._tokens, self._inverted, self._trie = records, tokens, inverted, trie
+            self.built_at = self.synced_at = time.time()
+            self._synced_to = scan_started
+        print(f"Patient search: indexed {len(records)} users in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    def ensure_built(self):
+        """Build on first use (or wait for the startup build); refresh and sync in the background.
+
+        A failed build is retried on the next search.
+        """
+        if self.built_at is None:
+            with self._build_lock:
+                if self.built_at is None:
+                    try:
+                        self.build()
+                    except Exception as e:
+                        print(f"Error building patient search index: {e}")
+            return
+
+        now = time.time()
+        if self.refresh_interval and now - self.built_at > self.refresh_interval:
+            self._start_background(self._background_rebuild)
+        elif self.sync_interval and now - self.synced_at > self.sync_interval:
+            self._start_background(self._background_sync)
+
+    def sync(self):
+        """Apply users created or edited (by any worker) since the last build or sync"""
+        scan_started = datetime.now(timezone.utc)
+        changed = list(self.firebase_db.stream_users_updated_since(self._synced_to - SYNC_OVERLAP))
+        with self._lock:
+            for user_data in changed:
+                self.add(user_data)
+            self.synced_at = time.time()
+            self._synced_to = scan_started
+
+    def add(self, user_data):
+        """Index a new user, or re-index an existing one"""
+        if not user_data or not user_data.get('id'):
+            return
+        with self._lock:
+            self._remove_locked(user_data['id'])
+            record = self._to_record(user_data)
+            self._records[record['id']] = record
+            self._tokens[record['id']] = tokenize(record)
+            for token in self._tokens[record['id']]:
+                self._inverted.setdefault(token, set()).add(record['id'])
+                self._trie_insert(self._trie, token, record['id'])
+
+    def update(self, user_id, **fields):
+        """Apply a partial profile update to an indexed user"""
+        with self._lock:
+            record = dict(self._records.get(user_id, {'id': user_id}))
+            record.update({key: value for key, value in fields.items() if key in SEARCH_FIELDS and value is not None})
+            self.add(record)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove_locked(user_id)
+
+    def search(self, query, limit=10):
+        """Return up to `limit` users matching every term of `query` (last term as a prefix)"""
+        terms = TOKEN_PATTERN.findall(query.lower())
+        if not terms:
+            return []
+
+        with self._lock:
+            matches = None
+            for i, term in enumerate(terms):
+                if len(terms) == 1:
+                    # Nothing to intersect with: stop at the shortest `limit` completions
+                    ids = self._prefix_ids(term, limit)
+                elif i == len(terms) - 1:
+                    ids = self._prefix_ids(term)
+                else:
+                    # Earlier terms are complete words, so allow exact or prefix matches
+                    ids = self._inverted.get(term) or self._prefix_ids(term)
+                matches = ids if matches is None else matches & ids
+                if not matches:
+                    return []
+
+            exact = self._inverted.get(terms[-1], set())
+            records = self._records
+            # Exact token hits first, then alphabetical; only the top `limit` are ordered
+            return heapq.nsmallest(limit, (records[user_id] for user_id in matches), key=lambda r: (
+                r['id'] not in exact, (r.get('first_name') or '').lower(), (r.get('last_name') or '').lower()
+            ))
+
+    def _start_background(self, target):
+        # Skip if a build or sync is already running; it released _build_lock when done
+        if self._build_lock.acquire(blocking=False):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _background_rebuild(self):
+        try:
+            self.build()
+        except Exception as e:
+            print(f"Error rebuilding patient search index: {e}")
+        finally:
+            self._build_lock.release()
+
+    def _background_sync(self):
+        try:
+            self.sync()
+        except Exception as e:
+            print(f"Error syncing patient search index: {e}")
+            # Try again after another sync interval rather than on every search
+            self.synced_at = time.time()
+        finally:
+            self._build_lock.release()
+
+    def _prefix_ids(self, prefix, limit=None):
+        node = self._trie
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return set()
+
+        # Breadth-first, so shorter (closer) completions are collected first
+        ids = set()
+        level = [node]
+        while level:
+            next_level = []
+            for node in level:
+                ids.update(node.ids)
+                next_level.extend(node.children.values())
+            if limit and len(ids) >= limit:
+                break
+            level = next_level
+        return ids
+
+    def _remove_locked(self, user_id):
+        self._records.pop(user_id, None)
+        for token in self._tokens.pop(user_id, ()):
+            ids = self._inverted.get(token)
+            if ids:
+                ids.discard(user_id)
+                if not ids:
+                    del self._inverted[token]
+            node = self._trie
+            for char in token:
+                node = node.children.get(char)
+                if node is None:
+                    break
+            else:
+                node.ids.discard(user_id)
+
+    @staticmethod
+    def _trie_insert(trie, token, user_id):
+        node = trie
+        for char in token:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = TrieNode()
+            node = child
+        node.ids.add(user_id)
+
+    @staticmethod
+    def _to_record(user_data):
+        record = {field: user_data.get(field) for field in SEARCH_FIELDS}
+        record['id'] = user_data['id']
+        return record
+
+# Global instance
+patient_search = PatientSearchIndex()
@@ -0,0 +1,328 @@
+import os
+import json
+import asyncio
+import inspect
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore as gcloud_firestore
+from google.cloud.firestore_v1.query import Query
+from google.cloud.firestore_v1.async_query import AsyncQuery
+from google.cloud.firestore_v1.aggregation import AggregationQuery
+from google.cloud.firestore_v1.async_aggregation import AsyncAggregationQuery
+from google.cloud.firestore_v1.base_aggregation import AggregationResult
+from reports import report_months
+
+# Generated from QUERY_SHAPES by `flask --app app firestore-indexes`; deploy with the Firebase CLI
+INDEXES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'firestore.indexes.json')
+
+# Filter operators that an index serves like equality (its fields lead the index)
+EQUALITY_OPS = {'EQUAL', 'IN', 'ARRAY_CONTAINS', 'ARRAY_CONTAINS_ANY', 'IS_NULL', 'IS_NAN'}
+ASCENDING = 'ASCENDING'
+DESCENDING = 'DESCENDING'
+
+
+class QueryShape:
+    """One kind of query the data layer issues: collection, filtered fields, ordering and bounds.
+
+    `optional` equality filters may each be present or not. A shape must be bounded (a
+    limit, or cursor pages of one) unless `unbounded` says why reading everything it
+    matches is acceptable; `count` shapes are server-side count() aggregations.
+    """
+
+    __slots__ = ('name', 'collection', 'equals', 'optional', 'range', 'order_by', 'count', 'unbounded')
+
+    def __init__(self, name, collection, equals=(), optional=(), range=None, order_by=(), count=False, unbounded=None):
+        self.name = name
+        self.collection = collection
+        self.equals = tuple(equals)
+        self.optional = tuple(optional)
+        self.range = range
+        self.order_by = tuple(order_by)
+        self.count = count
+        self.unbounded = unbounded
+
+    def matches(self, issued):
+        if (issued['collection'], issued['count']) != (self.collection, self.count):
+            return False
+        equals = set(issued['equals'])
+        if not set(self.equals) <= equals <= set(self.equals) | set(self.optional):
+            return False
+        if not set(issued['ranges']) <= ({self.range} if self.range else set()):
+            return False
+        return issued['order_by'] == self.order_by
+
+    def index_fields(self):
+        """Field lists of the composite indexes this shape needs (none if single-field indexes serve it)"""
+        order_by = list(self.order_by)
+        if self.range and self.range not in [field for field, _ in order_by]:
+            order_by.insert(0, (self.range, ASCENDING))
+        order_by = [(field, direction) for field, direction in order_by if field != '__name__']
+
+        # Firestore merges per-field indexes for combined optional equality filters
+        indexes = []
+        for extra in [()] + [(field,) for field in self.optional]:
+            fields = [(field, ASCENDING) for field in self.equals + extra] + order_by
+            if len(fields) > 1:
+                indexes.append(fields)
+        return indexes
+
+    def __repr__(self):
+        return f"<QueryShape {self.name}>"
+
+
+# Every query shape the data layer issues. A new query needs an entry here; regenerate
+# firestore.indexes.json afterwards and `flask verify-queries` checks callers against it.
+QUERY_SHAPES = [
+    # users
+    QueryShape('users_by_email', 'users', equals=['email']),
+    QueryShape('users_by_patient_card', 'users', equals=['patient_card_number']),
+    QueryShape('users_by_role', 'users', equals=['is_admin'],
+               unbounded='A handful of admin accounts, replaced by create_admin_user'),
+    QueryShape('users_newest', 'users', order_by=[('created_at', DESCENDING)]),
+    QueryShape('users_by_id', 'users', order_by=[('__name__', ASCENDING)]),
+    QueryShape('users_updated', 'users', range='updated_at', order_by=[('updated_at', ASCENDING)]),
+    QueryShape('users_count', 'users', count=True),
+    # appointments
+    QueryShape('appointments_newest', 'appointments', order_by=[('created_at', DESCENDING)]),
+    QueryShape('appointments_by_id', 'appointments', order_by=[('__name__', ASCENDING)]),
+    QueryShape('appointments_by_user', 'appointments', equals=['user_id'],
+               unbounded="One patient's appointments"),
+    # Exports, archiving and reminders (status 'in' counts as equality)
+    QueryShape('appointments_by_date', 'appointments', optional=['status'], range='date', order_by=[('date', ASCENDING)]),
+    QueryShape('appointments_to_archive', 'appointments', range='date', count=True),
+    QueryShape('appointments_with_attachments', 'appointments', range='attachment_url', order_by=[('attachment_url', ASCENDING)]),
+    QueryShape('appointments_count', 'appointments', optional=['status'], count=True),
+    # appointment_archive/{YYYY-MM} and its archived_appointments partitions
+    QueryShape('archive_partitions', 'appointment_archive', unbounded='One small counter document per month'),
+    QueryShape('archived_by_date', 'archived_appointments', optional=['user_id', 'status'], range='date',
+               order_by=[('date', ASCENDING)]),
+    QueryShape('archived_with_attachments', 'archived_appointments', range='attachment_url',
+               order_by=[('attachment_url', ASCENDING)]),
+    QueryShape('archived_by_id', 'archived_appointments', order_by=[('__name__', ASCENDING)]),
+    # diagnoses
+    QueryShape('diagnoses_by_user', 'diagnoses', equals=['user_id'], unbounded="One patient's diagnoses"),
+    QueryShape('diagnoses_by_created', 'diagnoses', optional=['user_id', 'status'], range='created_at',
+               order_by=[('created_at', ASCENDING)]),
+    # report_rollups/{YYYY-MM}
+    QueryShape('report_rollup_months', 'report_rollups', unbounded='One document per month, IDs only'),
+]
+
+# Listeners can't be limited; the live admin table watches the whole collection
+# (one initial read, then only changes). Declared here, not checked by the verifier.
+LISTENER_SHAPES = [
+    QueryShape('appointments_feed', 'appointments', unbounded='Live admin appointments listener'),
+]
+
+# Map and free-text fields never filtered or sorted on. Exempting them from single-field
+# indexing keeps the large timeline and rollup maps from writing index entries on every update.
+UNINDEXED_FIELDS = [
+    ('patient_timelines', 'appointments'),
+    ('patient_timelines', 'diagnoses'),
+    ('report_rollups', 'appointments'),
+    ('report_rollups', 'days'),
+    ('report_rollups', 'new_patients_days'),
+    ('appointments', 'notes'),
+    ('archived_appointments', 'notes'),
+]
+
+
+def index_manifest(shapes=None):
+    """The firestore.indexes.json document for the registered shapes"""
+    indexes = []
+    for shape in shapes or QUERY_SHAPES:
+        for fields in shape.index_fields():
+            index = {
+                'collectionGroup': shape.collection,
+                'queryScope': 'COLLECTION',
+                'fields': [{'fieldPath': field, 'order': direction} for field, direction in fields],
+            }
+            if index not in indexes:
+                indexes.append(index)
+    indexes.sort(key=lambda index: (index['collectionGroup'], [field['fieldPath'] for field in index['fields']]))
+    return {
+        'indexes': indexes,
+        'fieldOverrides': [
+            {'collectionGroup': collection, 'fieldPath': field, 'indexes': []}
+            for collection, field in UNINDEXED_FIELDS
+        ],
+    }
+
+
+def render_index_manifest(shapes=None):
+    return json.dumps(index_manifest(shapes), indent=2) + '\n'
+
+
+def describe_query(query, count=False):
+    """The shape of a Firestore query object, in the terms QueryShape matches on"""
+    equals, ranges = [], []
+    for field_filter in query._field_filters:
+        field = field_filter.field.field_path
+        (equals if field_filter.op.name in EQUALITY_OPS else ranges).append(field)
+    return {
+        'collection': query._parent.id,
+        'equals': tuple(equals),
+        'ranges': tuple(ranges),
+        'order_by': tuple((order.field.field_path, order.direction.name) for order in query._orders or ()),
+        'limited': query._limit is not None,
+        'count': count,
+    }
+
+
+class QueryVerifier:
+    """Record every query issued while active and check it against the registry.
+
+    A query is a violation if no registered shape matches it, or if it has no limit
+    and its shape doesn't declare why it may read everything. With `dry_run`, queries
+    return no documents (and counts zero) without contacting Firestore, so the data
+    layer's query shapes can be checked without credentials or an emulator.
+    """
+
+    def __init__(self, shapes=None, dry_run=False):
+        self.shapes = shapes or QUERY_SHAPES
+        self.dry_run = dry_run
+        self.issued = []
+        self.violations = []
+        self.errors = []
+        self.label = None
+        self._lock = threading.Lock()
+
+    def check(self, issued):
+        shape = next((shape for shape in self.shapes if shape.matches(issued)), None)
+        problem = None
+        if shape is None:
+            problem = 'unregistered query shape'
+        elif not issued['limited'] and not issued['count'] and not shape.unbounded:
+            problem = f"unbounded query (no limit) for shape '{shape.name}'"
+        with self._lock:
+            self.issued.append((self.label, issued, shape))
+            if problem:
+                self.violations.append((self.label, issued, problem))
+
+    def exercised(self):
+        return {shape.name for _, _, shape in self.issued if shape is not None}
+
+    @contextmanager
+    def active(self):
+        verifier = self
+        originals = {
+            (Query, 'stream'): Query.stream,
+            (AsyncQuery, 'stream'): AsyncQuery.stream,
+            (AggregationQuery, 'stream'): AggregationQuery.stream,
+            (AsyncAggregationQuery, 'stream'): AsyncAggregationQuery.stream,
+        }
+
+        # Query.get, CollectionReference.get/stream and Transaction.get(query) all end in stream()
+        def query_stream(self, *args, **kwargs):
+            verifier.check(describe_query(self))
+            if verifier.dry_run:
+                return iter(())
+            return originals[(Query, 'stream')](self, *args, **kwargs)
+
+        def async_query_stream(self, *args, **kwargs):
+            verifier.check(describe_query(self))
+            if verifier.dry_run:
+                return _empty_async()
+            return originals[(AsyncQuery, 'stream')](self, *args, **kwargs)
+
+        def aggregation_stream(self, *args, **kwargs):
+            verifier.check(describe_query(self._nested_query, count=True))
+            if verifier.dry_run:
+                return iter([[AggregationResult(alias='count', value=0, read_time=None)]])
+            return originals[(AggregationQuery, 'stream')](self, *args, **kwargs)
+
+        def async_aggregation_stream(self, *args, **kwargs):
+            verifier.check(describe_query(self._nested_query, count=True))
+            if verifier.dry_run:
+                return _empty_async([AggregationResult(alias='count', value=0, read_time=None)])
+            return originals[(AsyncAggregationQuery, 'stream')](self, *args, **kwargs)
+
+        Query.stream = query_stream
+        AsyncQuery.stream = async_query_stream
+        AggregationQuery.stream = aggregation_stream
+        AsyncAggregationQuery.stream = async_aggregation_stream
+        try:
+            yield self
+        finally:
+            for (cls, name), original in originals.items():
+                setattr(cls, name, original)
+
+
+async def _empty_async(*items):
+    for item in items:
+        yield item
+
+
+# Data-layer calls that between them issue the registered query shapes. Probes only
+# read, so --live is safe against production. Shapes only reached inside transactions,
+# through archive partitions (which dry runs don't have) or by writers such as
+# rebuild_report_rollups are reported as not exercised.
+def _probes(dry_run=True):
+    today = date.today()
+    probes = [
+        ('sync', 'get_user_by_email', ('probe@example.com',), {}),
+        ('sync', 'get_user_by_patient_number', ('FF000000',), {}),
+        ('sync', 'get_all_users', (), {'limit': 5}),
+        ('sync', 'stream_users', (), {}),
+        ('sync', 'stream_users_updated_since', (datetime.now(timezone.utc),), {}),
+        ('sync', 'get_patient_history', ('probe-user',), {}),
+        ('sync', 'get_appointments_by_user', ('probe-user',), {}),
+        ('sync', 'get_all_appointments', (), {}),
+        ('sync', 'stream_appointment_rows', (), {}),
+        ('sync', 'get_recent_appointments', (5,), {}),
+        ('sync', 'stream_appointments', (), {}),
+        ('sync', 'stream_appointments', (), {'start_date': today, 'end_date': today, 'status': 'pending'}),
+        ('sync', 'stream_diagnoses', (), {'user_id': 'probe-user', 'start_date': today, 'end_date': today}),
+        ('sync', 'stream_diagnoses', (), {'status': 'active', 'start_date': today}),
+        ('sync', 'stream_reminder_candidates', (today, today), {}),
+        ('sync', 'archive_appointments', (), {'dry_run': True}),
+        ('sync', 'stream_attachment_urls', (), {}),
+        ('sync', 'stream_archived_appointments', (), {'start_date': today, 'status': 'pending'}),
+        ('sync', 'get_archive_months', (), {}),
+        ('sync', 'get_user_count', (), {}),
+        ('sync', 'get_appointment_count', (), {'include_archived': True}),
+        ('sync', 'get_pending_appointments_count', (), {}),
+        ('async', 'get_all_users', (), {'limit': 5}),
+        ('async', 'get_recent_appointments', (5,), {}),
+        ('async', 'get_archive_months', (), {}),
+        ('async', 'get_user_count', (), {}),
+        ('async', 'get_appointment_count', (), {'include_archived': True}),
+        ('async', 'get_pending_appointments_count', (), {}),
+    ]
+    if not dry_run:
+        # Document gets, not queries: the verifier can't answer them offline
+        probes.append(('sync', 'get_report_rollups', (tuple(report_months(3, today)),), {}))
+    return probes
+
+
+def verify_data_layer(sync_db, async_db, dry_run=True):
+    """Run every probe under a QueryVerifier; returns the verifier with its findings"""
+    verifier = QueryVerifier(dry_run=dry_run)
+    clients = None
+    if dry_run:
+        # Offline clients: queries are answered by the verifier, nothing reaches the network
+        async_db._client_loop()
+        clients = (sync_db.db, async_db.db)
+        sync_db.db = gcloud_firestore.Client(project='query-verifier', credentials=AnonymousCredentials())
+        async_db.db = gcloud_firestore.AsyncClient(project='query-verifier', credentials=AnonymousCredentials())
+
+    try:
+        with verifier.active():
+            for target, method_name, args, kwargs in _probes(dry_run):
+                verifier.label = f"{target} {method_name}"
+                try:
+                    if target == 'sync':
+                        result = getattr(sync_db, method_name)(*args, **kwargs)
+                        if inspect.isgenerator(result):
+                            for _ in result:
+                                pass
+                    else:
+                        asyncio.run(getattr(async_db, method_name)(*args, **kwargs))
+                except Exception as e:
+                    print(f"Error running query probe {verifier.label}: {e}")
+                    verifier.errors.append((verifier.label, str(e)))
+    finally:
+        if clients is not None:
+            sync_db.db, async_db.db = clients
+    return verifier
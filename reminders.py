@@ -0,0 +1,136 @@
+import os
+import time
+import smtplib
+from contextlib import ExitStack
+from datetime import date, datetime, timedelta
+from flask import current_app
+from flask_mail import Message
+from firebase_db import firebase_db
+
+# Messages per second over the shared SMTP session (0 disables throttling)
+REMINDER_SEND_RATE = float(os.environ.get('REMINDER_SEND_RATE', 5))
+# Appointments claimed and looked up per Firestore round trip (each send is recorded as it happens)
+REMINDER_CHUNK_SIZE = int(os.environ.get('REMINDER_CHUNK_SIZE', 100))
+# A claim not marked sent or failed within this many seconds (the run died) may be taken again
+REMINDER_CLAIM_LEASE = int(os.environ.get('REMINDER_CLAIM_LEASE', 900))
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ReminderSender:
+    """Sends appointment reminders in chunks over one reused, throttled SMTP connection"""
+
+    def __init__(self, mail, db=None, send_rate=None, chunk_size=None):
+        self.mail = mail
+        self.firebase_db = db or firebase_db
+        self.send_rate = REMINDER_SEND_RATE if send_rate is None else send_rate
+        self.chunk_size = chunk_size or REMINDER_CHUNK_SIZE
+
+    def send_for_day(self, day=None, max_messages=None, dry_run=False):
+        """Remind patients of their appointments on `day` (tomorrow by default); must run in an app context"""
+        day = day or date.today() + timedelta(days=1)
+        stats = {'date': day.isoformat(), 'candidates': 0, 'sent': 0, 'skipped': 0, 'failed': 0}
+        candidates = self.firebase_db.stream_reminder_candidates(day, day)
+        if dry_run:
+            stats['candidates'] = sum(1 for _ in candidates)
+            return stats
+
+        template = current_app.jinja_env.get_template('email/appointment_reminder.txt')
+        interval = 1.0 / self.send_rate if self.send_rate > 0 else 0
+        next_send = time.monotonic()
+
+        with ExitStack() as stack:
+            connection = None
+            for chunk in _chunks(candidates, self.chunk_size):
+                if max_messages is not None:
+                    chunk = chunk[:max_messages - stats['sent'] - stats['failed']]
+                    if not chunk:
+                        break
+                stats['candidates'] += len(chunk)
+
+                claimed = set(self.firebase_db.claim_reminders([appointment['id'] for appointment in chunk],
+                                                               lease_seconds=REMINDER_CLAIM_LEASE))
+                stats['skipped'] += len(chunk) - len(claimed)
+                chunk = [appointment for appointment in chunk if appointment['id'] in claimed]
+                if not chunk:
+                    continue
+
+                sent, recorded, failed = [], set(), {}
+                try:
+                    users = self.firebase_db.get_user_summaries(appointment['user_id'] for appointment in chunk)
+                    for appointment in chunk:
+                        user = users.get(appointment['user_id'])
+                        if not user or not user.get('email'):
+                            failed[appointment['id']] = 'Patient has no email address'
+                            continue
+
+                        message = self.build_message(template, appointment, user)
+                        if connection is None:
+                            connection = stack.enter_context(self.mail.connect())
+
+                        # Space messages out so the SMTP relay never sees a burst
+                        delay = next_send - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                        next_send = max(next_send, time.monotonic()) + interval
+
+                        try:
+                            self._send(connection, message)
+                        except Exception as e:
+                            print(f"Error sending reminder for appointment {appointment['id']}: {e}")
+                            failed[appointment['id']] = e
+                            continue
+
+                        # Record each delivery before the next send: a run killed mid-chunk must not
+                        # leave a delivered reminder claimed, or the next run resends it once the lease expires
+                        sent.append(appointment['id'])
+                        self.firebase_db.mark_reminders([appointment['id']])
+                        recorded.add(appointment['id'])
+                except BaseException as e:
+                    # e.g. the SMTP connection couldn't be opened: release the rest of the chunk's
+                    # claims as failed so the next run retries them
+                    for appointment in chunk:
+                        if appointment['id'] not in sent:
+                            failed.setdefault(appointment['id'], e)
+                    raise
+                finally:
+                    self.firebase_db.mark_reminders([appointment_id for appointment_id in sent if appointment_id not in recorded], failed)
+                    stats['sent'] += len(sent)
+                    stats['failed'] += len(failed)
+
+        print(f"Reminders for {stats['date']}: {stats['sent']} sent, {stats['skipped']} already handled, {stats['failed']} failed")
+        return stats
+
+    @staticmethod
+    def build_message(template, appointment, user):
+        day = datetime.strptime(appointment['date'], '%Y-%m-%d')
+        context = {
+            'appointment': appointment,
+            'patient': user,
+            'day': day.strftime('%A, %d %B %Y'),
+            'time': (appointment.get('time') or '')[:5],
+        }
+        return Message(
+            subject=f"Reminder: your {appointment['service']} appointment on {day.strftime('%d %B')}",
+            recipients=[user['email']],
+            body=template.render(**context)
+        )
+
+    @staticmethod
+    def _send(connection, message):
+        try:
+            connection.send(message)
+        except smtplib.SMTPServerDisconnected:
+            # The relay dropped an idle or long-lived session; reconnect once and retry
+            connection.host = connection.configure_host()
+            connection.num_emails = 0
+            connection.send(message)
@@ -0,0 +1,48 @@
+from datetime import date
+
+# Statuses in funnel order; any others found in the rollups follow these
+STATUS_ORDER = ['pending', 'confirmed', 'completed', 'cancelled']
+
+# The reports page covers at most this many months (one rollup document each)
+MAX_REPORT_MONTHS = 36
+
+
+def report_months(count, today=None):
+    """The last `count` YYYY-MM months, oldest first, ending with the current month"""
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1
+    return [f"{i // 12:04d}-{i % 12 + 1:02d}" for i in range(index - count + 1, index + 1)]
+
+
+def summarize_rollups(rollups):
+    """Shape report_rollups documents (oldest first) into the tables the reports page renders"""
+    months = [rollup['month'] for rollup in rollups]
+    services = {}
+    statuses = {}
+    month_totals = []
+    new_patients = []
+    for rollup in rollups:
+        month_total = 0
+        for service, counts in (rollup.get('appointments') or {}).items():
+            service_total = sum(counts.values())
+            per_month = services.setdefault(service, {})
+            per_month[rollup['month']] = service_total
+            month_total += service_total
+            for status, count in counts.items():
+                statuses[status] = statuses.get(status, 0) + count
+        month_totals.append(month_total)
+        new_patients.append(rollup.get('new_patients', 0))
+
+    status_rank = {status: rank for rank, status in enumerate(STATUS_ORDER)}
+    return {
+        'months': months,
+        'services': [
+            {'service': service, 'counts': [per_month.get(month, 0) for month in months], 'total': sum(per_month.values())}
+            for service, per_month in sorted(services.items(), key=lambda item: -sum(item[1].values()))
+        ],
+        'month_totals': month_totals,
+        'total': sum(month_totals),
+        'statuses': sorted(statuses.items(), key=lambda item: (status_rank.get(item[0], len(STATUS_ORDER)), item[0])),
+        'new_patients': new_patients,
+        'new_patients_total': sum(new_patients),
+    }
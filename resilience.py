@@ -0,0 +1,386 @@
+import os
+import copy
+import asyncio
+import time
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import wraps
+from google.api_core import exceptions as api_exceptions
+
+# Deadline for one Firestore operation (all its round trips and retries), in seconds
+FIRESTORE_READ_TIMEOUT = float(os.environ.get('FIRESTORE_READ_TIMEOUT', 5))
+FIRESTORE_WRITE_TIMEOUT = float(os.environ.get('FIRESTORE_WRITE_TIMEOUT', 10))
+# Export pages and maintenance batches move more data per call
+FIRESTORE_BATCH_TIMEOUT = float(os.environ.get('FIRESTORE_BATCH_TIMEOUT', 30))
+# Extra attempts for idempotent reads that fail with a transient error
+FIRESTORE_READ_RETRIES = int(os.environ.get('FIRESTORE_READ_RETRIES', 2))
+# Firestore calls a worker process may have outstanding at once, including abandoned ones
+FIRESTORE_MAX_INFLIGHT = int(os.environ.get('FIRESTORE_MAX_INFLIGHT', 32))
+# Consecutive failures that open the breaker, and how long it stays open before probing
+FIRESTORE_BREAKER_THRESHOLD = int(os.environ.get('FIRESTORE_BREAKER_THRESHOLD', 5))
+FIRESTORE_BREAKER_RESET = float(os.environ.get('FIRESTORE_BREAKER_RESET', 30))
+# Last good read results kept per process, served while Firestore is unreachable
+FIRESTORE_STALE_ENTRIES = int(os.environ.get('FIRESTORE_STALE_ENTRIES', 512))
+
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 1.0
+
+
+class BackendUnavailableError(Exception):
+    """Firestore can't be used right now; the call was not (or not fully) made"""
+
+
+class CircuitOpenError(BackendUnavailableError):
+    pass
+
+
+class OperationTimeoutError(BackendUnavailableError):
+    pass
+
+
+# Errors that say something about the backend's health (as opposed to the request)
+TRANSIENT_ERRORS = (
+    api_exceptions.ServerError,        # INTERNAL, UNAVAILABLE, DEADLINE_EXCEEDED, UNKNOWN
+    api_exceptions.TooManyRequests,    # RESOURCE_EXHAUSTED
+    api_exceptions.RetryError,
+    OperationTimeoutError,
+    ConnectionError,
+)
+
+
+class CircuitBreaker:
+    """Closed until enough consecutive failures, then open (fail fast); half-open lets one probe through"""
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self.failures = 0
+        self.short_circuited = 0
+        self.last_error = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go to the backend now"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._probing = False
+            if self.state != 'closed':
+                print(f"Circuit breaker {self.name}: closed")
+                self.state = 'closed'
+                self.opened_at = None
+
+    def release(self):
+        """Give up a probe slot without a verdict (the call never reached the backend)"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"[:200]
+            self._probing = False
+            if self.state == 'half_open' or (self.state == 'closed' and self.consecutive_failures >= self.failure_threshold):
+                print(f"Circuit breaker {self.name}: open for {self.reset_timeout}s after {self.last_error}")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'open_for_seconds': round(time.monotonic() - self.opened_at, 1) if self.opened_at else None,
+                'times_opened': self.times_opened,
+                'failures': self.failures,
+                'short_circuited': self.short_circuited,
+                'last_error': self.last_error,
+            }
+
+
+class StaleCache:
+    """Bounded LRU of the last successful result per read"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.served = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """(found, value); lists and dicts are copied so callers can't sort or edit the cached one"""
+        with self._lock:
+            if key not in self._entries:
+                return False, None
+            self.served += 1
+            value = self._entries[key]
+        return True, copy.copy(value)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FirestoreGuard:
+    """Runs Firestore operations with a deadline, jittered retries and a circuit breaker.
+
+    Each operation runs on a bounded per-process pool so the calling request thread
+    can give up at its deadline; a call that overruns keeps its pool slot until the
+    client returns, and once every slot is stuck new calls fail fast instead of queueing.
+    """
+
+    def __init__(self, max_inflight=None, breaker=None, stale=None):
+        self.max_inflight = max_inflight or FIRESTORE_MAX_INFLIGHT
+        self.breaker = breaker or CircuitBreaker('firestore', FIRESTORE_BREAKER_THRESHOLD, FIRESTORE_BREAKER_RESET)
+        self.stale = stale or StaleCache(FIRESTORE_STALE_ENTRIES)
+        self.calls = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.rejected = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._slots = None
+        self._inflight = 0
+
+    def nested(self):
+        """True inside a guarded operation, whose deadline already covers this call"""
+        return getattr(self._local, 'active', False)
+
+    def call(self, fn, timeout, retries=0):
+        """Run fn() under the breaker with an overall deadline; transient errors are retried with jitter"""
+        if self.nested():
+            return fn()
+
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError("Firestore circuit breaker is open")
+            try:
+                result = self._run(fn, deadline - time.monotonic(), timeout)
+            except TRANSIENT_ERRORS as e:
+                self.breaker.record_failure(e)
+                # Full jitter, so workers retrying after the same blip don't retry together
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                if attempt >= retries or time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                self.retries += 1
+                time.sleep(delay)
+                continue
+            except BackendUnavailableError:
+                self.breaker.release()
+                raise
+            except Exception:
+                # The backend answered; the request itself was bad (not found, precondition, ...)
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, coro_fn, timeout, retries=0):
+        """Coroutine counterpart of call(): the same breaker, deadline and retry policy, without a pool thread"""
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError("Firestore circuit breaker is open")
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise OperationTimeoutError(f"Firestore operation exceeded its {timeout}s deadline")
+                self.calls += 1
+                try:
+                    result = await asyncio.wait_for(coro_fn(), remaining)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    raise OperationTimeoutError(f"Firestore operation exceeded its {timeout}s deadline") from None
+            except TRANSIENT_ERRORS as e:
+                self.breaker.record_failure(e)
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                if attempt >= retries or time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def _run(self, fn, remaining, timeout):
+        if remaining <= 0:
+            raise OperationTimeoutError(f"Firestore operation exceeded its {timeout}s deadline")
+
+        executor, slots = self._pool()
+        if not slots.acquire(blocking=False):
+            self.rejected += 1
+            raise BackendUnavailableError(f"{self.max_inflight} Firestore calls already in flight")
+
+        with self._lock:
+            self.calls += 1
+            self._inflight += 1
+        future = executor.submit(self._invoke, fn, slots)
+        try:
+            return future.result(timeout=remaining)
+        except FutureTimeoutError:
+            self.timeouts += 1
+            raise OperationTimeoutError(f"Firestore operation exceeded its {timeout}s deadline") from None
+
+    def _invoke(self, fn, slots):
+        self._local.active = True
+        try:
+            return fn()
+        finally:
+            self._local.active = False
+            with self._lock:
+                self._inflight -= 1
+            slots.release()
+
+    def _pool(self):
+        # Threads don't survive fork, so each worker process builds its own pool
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_inflight, thread_name_prefix='firestore')
+                self._slots = threading.BoundedSemaphore(self.max_inflight)
+                self._inflight = 0
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+    def stats(self):
+        return {
+            'breaker': self.breaker.stats(),
+            'calls': self.calls,
+            'in_flight': self._inflight if self._pid == os.getpid() else 0,
+            'max_in_flight': self.max_inflight,
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'stale_entries': len(self.stale),
+            'stale_served': self.stale.served,
+            'deadlines': {
+                'read': FIRESTORE_READ_TIMEOUT,
+                'write': FIRESTORE_WRITE_TIMEOUT,
+                'batch': FIRESTORE_BATCH_TIMEOUT,
+            },
+        }
+
+
+def _fallback(default):
+    return default() if callable(default) else default
+
+
+def _stale_key(method, args, kwargs):
+    """Stale-cache key for a call, or None (not cached) if its arguments aren't hashable"""
+    key = (method.__name__, args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def read_operation(default=None, stale=True, timeout=None):
+    """Guard an idempotent FirebaseDB read: deadline, retries, then the last good result or `default`"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if firestore_guard.nested():
+                return method(self, *args, **kwargs)
+
+            key = _stale_key(method, args, kwargs) if stale else None
+            try:
+                result = firestore_guard.call(lambda: method(self, *args, **kwargs),
+                                              timeout or FIRESTORE_READ_TIMEOUT, retries=FIRESTORE_READ_RETRIES)
+            except Exception as e:
+                print(f"Error in {method.__name__}: {e}")
+                if key is not None:
+                    found, value = firestore_guard.stale.get(key)
+                    if found:
+                        print(f"Serving stale {method.__name__} result")
+                        return value
+                return _fallback(default)
+
+            if key is not None:
+                firestore_guard.stale.put(key, result)
+            return result
+        return wrapper
+    return decorator
+
+
+def async_read_operation(default=None, stale=True, timeout=None):
+    """read_operation for coroutine methods; shares the stale cache with their sync twins of the same name"""
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            key = _stale_key(method, args, kwargs) if stale else None
+            try:
+                result = await firestore_guard.call_async(lambda: method(self, *args, **kwargs),
+                                                          timeout or FIRESTORE_READ_TIMEOUT, retries=FIRESTORE_READ_RETRIES)
+            except Exception as e:
+                print(f"Error in async {method.__name__}: {e}")
+                if key is not None:
+                    found, value = firestore_guard.stale.get(key)
+                    if found:
+                        print(f"Serving stale {method.__name__} result")
+                        return value
+                return _fallback(default)
+
+            if key is not None:
+                firestore_guard.stale.put(key, result)
+            return result
+        return wrapper
+    return decorator
+
+
+def write_operation(default=None, timeout=None, propagate=()):
+    """Guard a FirebaseDB write: deadline and breaker, no retries; errors in `propagate` are re-raised"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if firestore_guard.nested():
+                return method(self, *args, **kwargs)
+
+            try:
+                return firestore_guard.call(lambda: method(self, *args, **kwargs), timeout or FIRESTORE_WRITE_TIMEOUT)
+            except propagate:
+                raise
+            except Exception as e:
+                print(f"Error in {method.__name__}: {e}")
+                return _fallback(default)
+        return wrapper
+    return decorator
+
+# Global instance
+firestore_guard = FirestoreGuard()
@@ -0,0 +1,88 @@
+import os
+import re
+from datetime import datetime, date, timedelta
+
+# Clinic schedule; each service has one bookable line per slot
+CLINIC_OPEN = os.environ.get('CLINIC_OPEN', '09:00')
+CLINIC_CLOSE = os.environ.get('CLINIC_CLOSE', '17:00')
+SLOT_MINUTES = int(os.environ.get('SLOT_MINUTES', 30))
+# Weekday numbers (Monday=0) the clinic takes bookings
+CLINIC_DAYS = {int(day) for day in os.environ.get('CLINIC_DAYS', '0,1,2,3,4,5').split(',') if day.strip()}
+
+
+class SlotUnavailableError(Exception):
+    """Raised when a requested slot is outside clinic hours or already taken"""
+
+
+class InvalidStatusTransitionError(Exception):
+    """Raised when an appointment can't move from its current status to the requested one"""
+
+
+# Cancelling hands the slot back to the bitmap and someone may have booked it since,
+# so a cancelled appointment stays cancelled; the patient books again instead
+APPOINTMENT_TRANSITIONS = {
+    'pending': {'confirmed', 'completed', 'cancelled'},
+    'confirmed': {'pending', 'completed', 'cancelled'},
+    'completed': {'pending', 'confirmed', 'cancelled'},
+    'cancelled': set(),
+}
+
+
+def check_status_transition(current, status):
+    """Raise InvalidStatusTransitionError unless an appointment may go from `current` to `status`"""
+    if current == status or status in APPOINTMENT_TRANSITIONS.get(current or 'pending', ()):
+        return
+    raise InvalidStatusTransitionError(f"A {current} appointment can't be marked {status}")
+
+
+def _parse_clock(value):
+    return datetime.strptime(value, '%H:%M').time()
+
+
+def slot_times():
+    """Start times of every slot in a clinic day"""
+    start = datetime.combine(date.min, _parse_clock(CLINIC_OPEN))
+    end = datetime.combine(date.min, _parse_clock(CLINIC_CLOSE))
+    times = []
+    while start + timedelta(minutes=SLOT_MINUTES) <= end:
+        times.append(start.time())
+        start += timedelta(minutes=SLOT_MINUTES)
+    return times
+
+
+def slot_index(slot_time):
+    """Bit position of a slot start time, or None if it isn't a slot boundary"""
+    if isinstance(slot_time, str):
+        slot_time = _parse_clock(slot_time[:5])
+    slot_time = slot_time.replace(second=0, microsecond=0)
+    try:
+        return slot_times().index(slot_time)
+    except ValueError:
+        return None
+
+
+def is_clinic_day(day):
+    return day.weekday() in CLINIC_DAYS
+
+
+def service_key(service):
+    """Stable, document-ID-safe key for a service name"""
+    return re.sub(r'[^a-z0-9]+', '-', service.lower()).strip('-')
+
+
+def slot_document_id(day, service):
+    """One slot document per day and service"""
+    return f"{day.isoformat()}_{service_key(service)}"
+
+
+def describe_slots(day, booked_mask, now=None):
+    """Expand a booked bitmap into the availability list served to the booking form"""
+    now = now or datetime.now()
+    slots = []
+    for index, slot_time in enumerate(slot_times()):
+        starts_at = datetime.combine(day, slot_time)
+        slots.append({
+            'time': slot_time.strftime('%H:%M'),
+            'available': is_clinic_day(day) and starts_at > now and not booked_mask & (1 << index),
+        })
+    return slots
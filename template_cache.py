@@ -0,0 +1,97 @@
+import os
+import time
+import tempfile
+from jinja2 import FileSystemBytecodeCache
+
+# Compiled template bytecode; precompiled at deploy time, or filled on first compile
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+# Compile every template at import time so the first request doesn't pay for it
+TEMPLATE_WARMUP = os.environ.get('TEMPLATE_WARMUP', '1') != '0'
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache that reads a (possibly read-only) deploy directory and writes wherever it can"""
+
+    def __init__(self, directory, fallback_directory):
+        super().__init__(directory)
+        self.fallback = FileSystemBytecodeCache(fallback_directory) if fallback_directory != directory else None
+        self.hits = {}
+
+    def get_bucket(self, environment, name, filename, source):
+        bucket = super().get_bucket(environment, name, filename, source)
+        if bucket.code is None and self.fallback is not None:
+            self.fallback.load_bytecode(bucket)
+        self.hits[name] = bucket.code is not None
+        return bucket
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            # Read-only deploy directory (e.g. Vercel); keep a per-instance copy instead
+            if self.fallback is not None:
+                try:
+                    self.fallback.dump_bytecode(bucket)
+                except OSError:
+                    pass
+
+
+def _writable_directory(directory):
+    try:
+        os.makedirs(directory, exist_ok=True)
+        return os.access(directory, os.W_OK)
+    except OSError:
+        return False
+
+
+def configure_template_cache(app):
+    """Attach a persistent bytecode cache to the app's Jinja environment"""
+    directory = TEMPLATE_CACHE_DIR or os.path.join(app.root_path, '.jinja_cache')
+    fallback = os.path.join(tempfile.gettempdir(), 'fixandfit-jinja-cache')
+    if not os.path.isdir(directory) and not _writable_directory(directory):
+        directory = fallback
+    _writable_directory(fallback)
+
+    cache = TemplateBytecodeCache(directory, fallback)
+    app.jinja_env.bytecode_cache = cache
+    return cache
+
+
+def warm_templates(app, report=True):
+    """Load every template into the Jinja environment; returns per-template timings"""
+    env = app.jinja_env
+    cache = env.bytecode_cache
+    names = env.list_templates()
+    if env.cache is not None and env.cache.capacity < len(names):
+        print(f"Template warm-up: Jinja cache holds {env.cache.capacity} of {len(names)} templates")
+
+    timings = []
+    started = time.perf_counter()
+    for name in names:
+        template_started = time.perf_counter()
+        try:
+            env.get_template(name)
+        except Exception as e:
+            print(f"Template warm-up: failed to compile {name}: {e}")
+            continue
+        from_cache = bool(cache is not None and getattr(cache, 'hits', {}).get(name))
+        timings.append({
+            'template': name,
+            'ms': round((time.perf_counter() - template_started) * 1000, 2),
+            'source': 'bytecode' if from_cache else 'compiled',
+        })
+
+    summary = {
+        'templates': len(timings),
+        'from_bytecode': sum(1 for timing in timings if timing['source'] == 'bytecode'),
+        'total_ms': round((time.perf_counter() - started) * 1000, 1),
+        'timings': sorted(timings, key=lambda timing: timing['ms'], reverse=True),
+    }
+    app.extensions['template_warmup'] = summary
+
+    if report:
+        print(f"Template warm-up: {summary['templates']} templates in {summary['total_ms']}ms "
+              f"({summary['from_bytecode']} from bytecode cache)")
+        for timing in summary['timings']:
+            print(f"  {timing['ms']:8.2f}ms  {timing['source']:<8}  {timing['template']}")
+    return summary